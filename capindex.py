@@ -0,0 +1,219 @@
+# Capcodes index: description, ignore flag and discipline of a capcode in one lookup
+#
+# Capcodes are stored as integers in a sorted array, with parallel arrays for
+# the description number and flags, so one record takes ~9 bytes plus the
+# (interned) description text.
+#
+# The index can be saved to a binary snapshot, that is memory-mapped at the
+# next start instead of parsing the text files again. The snapshot keeps the
+# size and mtime of all source files and is not used if any of them changed.
+
+import os
+import sys
+import json
+import mmap
+import struct
+import bisect
+from array import array
+from collections import namedtuple
+
+FLAG_IGNORE = 0x01
+DISCIPLINE_SHIFT = 4  # discipline (sender type) is kept in the upper 4 bits of flags
+
+CapcodeInfo = namedtuple("CapcodeInfo", ["description", "ignore", "discipline"])
+
+SNAPSHOT_MAGIC = b"P2KCAPS2"  # changed when the records meaning changes, older snapshots are rebuilt
+# magic, byteorder, records count, descriptions count, text size, sources size
+SNAPSHOT_HEADER = struct.Struct("<8s8sIIII")
+
+
+def capcodeToInt(capcode):
+    try:
+        return int(capcode)
+    except (TypeError, ValueError):
+        return None
+
+
+class CapcodeIndex(object):
+
+    def __init__(self):
+        self.capcodes = array('I')
+        self.desc_ids = array('I')
+        self.flags = array('B')
+        self.descriptions = [""]
+        self.pending = dict()  # capcode => [description id, flags], before freeze()
+        self.desc_lookup = {"": 0}
+
+    def record(self, capcode):
+        key = capcodeToInt(capcode)
+        if key is None or key < 0 or key > 0xFFFFFFFF:
+            return None
+        if not isinstance(self.descriptions, list):
+            self.unmap()
+        rec = self.pending.get(key)
+        if rec is None:
+            # Start from the already frozen record, if any
+            pos = self.position(key)
+            rec = [self.desc_ids[pos], self.flags[pos]] if pos is not None else [0, 0]
+            self.pending[key] = rec
+        return rec
+
+    def position(self, key):
+        pos = bisect.bisect_left(self.capcodes, key)
+        if pos == len(self.capcodes) or self.capcodes[pos] != key:
+            return None
+        return pos
+
+    def addDescription(self, capcode, description):
+        rec = self.record(capcode)
+        if rec is None:
+            return
+        if self.desc_lookup is None:
+            self.desc_lookup = {d: p for p, d in enumerate(self.descriptions)}
+        desc_id = self.desc_lookup.get(description)
+        if desc_id is None:
+            desc_id = len(self.descriptions)
+            self.descriptions.append(description)
+            self.desc_lookup[description] = desc_id
+        rec[0] = desc_id
+
+    def addIgnore(self, capcode):
+        rec = self.record(capcode)
+        if rec is not None:
+            rec[1] |= FLAG_IGNORE
+
+    def addDiscipline(self, capcode, discipline):
+        # The first classifier file with the capcode wins (police, fire, ambulance order of loading)
+        rec = self.record(capcode)
+        if rec is not None and (rec[1] >> DISCIPLINE_SHIFT) & 0x0F == 0:
+            rec[1] = (rec[1] & 0x0F) | ((discipline & 0x0F) << DISCIPLINE_SHIFT)
+
+    def freeze(self):
+        # Merge added records into the sorted arrays, should be called after loading
+        for p in range(len(self.capcodes)):
+            key = self.capcodes[p]
+            if key not in self.pending:
+                self.pending[key] = [self.desc_ids[p], self.flags[p]]
+        keys = sorted(self.pending.keys())
+        self.capcodes = array('I', keys)
+        self.desc_ids = array('I', (self.pending[k][0] for k in keys))
+        self.flags = array('B', (self.pending[k][1] for k in keys))
+        self.pending = dict()
+        self.desc_lookup = None
+
+    def __len__(self):
+        return len(self.capcodes)
+
+    def lookup(self, capcode):
+        # CapcodeInfo or None if the capcode is unknown
+        key = capcodeToInt(capcode)
+        if key is None:
+            return None
+        pos = self.position(key)
+        if pos is None:
+            return None
+        flags = self.flags[pos]
+        return CapcodeInfo(self.descriptions[self.desc_ids[pos]], (flags & FLAG_IGNORE) != 0, flags >> DISCIPLINE_SHIFT)
+
+    # Binary snapshot
+
+    @staticmethod
+    def sourcesSignature(sources):
+        # Size and mtime of the source text files, missing files are also noted
+        signature = []
+        for path in sources:
+            try:
+                st = os.stat(path)
+                signature.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+            except OSError:
+                signature.append([os.path.abspath(path), -1, 0])
+        return json.dumps(signature).encode("utf-8")
+
+    def saveSnapshot(self, filename, sources):
+        if len(self.pending) > 0:
+            self.freeze()
+        texts = [self.descriptions[p].encode("utf-8") for p in range(len(self.descriptions))]
+        offsets = array('I', [0])
+        for t in texts:
+            offsets.append(offsets[-1] + len(t))
+        signature = self.sourcesSignature(sources)
+        flags = bytes(self.flags)
+        flags += b"\0"*(-len(flags) % 4)  # keep the next arrays aligned
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sys.byteorder.encode("ascii"), len(self.capcodes),
+                                      len(texts), offsets[-1], len(signature))
+        signature += b"\0"*(-len(signature) % 4)
+
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, "wb") as f:
+                f.write(header)
+                f.write(signature)
+                f.write(array('I', self.capcodes).tobytes())
+                f.write(array('I', self.desc_ids).tobytes())
+                f.write(flags)
+                f.write(offsets.tobytes())
+                f.write(b"".join(texts))
+            os.replace(tmp_filename, filename)
+            return True
+        except OSError as e:
+            print("Capcodes snapshot save error: {}".format(e))
+            return False
+
+    @classmethod
+    def loadSnapshot(cls, filename, sources):
+        # Memory-mapped index, or None if the snapshot is missing or outdated
+        try:
+            with open(filename, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, byteorder, n, d, text_size, sig_size = SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC or byteorder.rstrip(b"\0") != sys.byteorder.encode("ascii"):
+                return None
+            pos = SNAPSHOT_HEADER.size
+            if bytes(data[pos:pos + sig_size]) != cls.sourcesSignature(sources):
+                return None
+            pos += sig_size + (-sig_size % 4)
+
+            view = memoryview(data)
+            index = cls()
+            index.capcodes = view[pos:pos + 4*n].cast('I')
+            pos += 4*n
+            index.desc_ids = view[pos:pos + 4*n].cast('I')
+            pos += 4*n
+            index.flags = view[pos:pos + n]
+            pos += n + (-n % 4)
+            offsets = view[pos:pos + 4*(d + 1)].cast('I')
+            pos += 4*(d + 1)
+            index.descriptions = SnapshotStrings(offsets, view[pos:pos + text_size])
+            index.desc_lookup = None
+            return index
+        except (struct.error, ValueError, TypeError):
+            return None
+
+    def unmap(self):
+        # Copy memory-mapped data to normal arrays, so the index can be changed
+        self.capcodes = array('I', self.capcodes)
+        self.desc_ids = array('I', self.desc_ids)
+        self.flags = array('B', self.flags)
+        self.descriptions = [self.descriptions[p] for p in range(len(self.descriptions))]
+        self.desc_lookup = None
+
+    def description(self, capcode):
+        info = self.lookup(capcode)
+        return info.description if info is not None else ""
+
+
+class SnapshotStrings(object):
+    # Descriptions from the snapshot, decoded only when requested
+
+    def __init__(self, offsets, text):
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.text[self.offsets[index]:self.offsets[index + 1]], "utf-8")
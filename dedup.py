@@ -0,0 +1,35 @@
+# Time-windowed key index, used to find duplicates of recently received messages
+
+from collections import OrderedDict
+
+
+class TimedIndex(object):
+    # All keys share the same lifetime, so insertion order is also the expiry order
+
+    def __init__(self, window_s):
+        self.window_s = window_s
+        self.items = OrderedDict()
+
+    def expire(self, now):
+        items = self.items
+        while len(items) > 0:
+            key, (time_added, value) = next(iter(items.items()))
+            if now - time_added < self.window_s:
+                break
+            items.popitem(last=False)
+
+    def get(self, key, now):
+        # Value stored for the key in the time window, or None.
+        # Times from several receivers can be a bit out of order, so the item itself is checked too
+        self.expire(now)
+        item = self.items.get(key)
+        if item is None or abs(now - item[0]) >= self.window_s:
+            return None
+        return item[1]
+
+    def put(self, key, value, now):
+        self.items[key] = (now, value)
+        self.items.move_to_end(key)
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,115 @@
+# Capcode filter: wildcard patterns (fnmatch style, * and ?) compiled into one matcher
+#
+# Patterns without wildcards are kept in a set, "prefix*" patterns in a prefix
+# trie, all other patterns are combined into one regex. Results are cached per
+# capcode, so the cost does not depend on the number of patterns.
+
+import re
+import fnmatch
+import threading
+from collections import OrderedDict
+
+
+def isPrefixPattern(pattern):
+    # "00118*": only one trailing '*' and no other wildcards
+    return pattern.endswith('*') and not any(c in pattern[:-1] for c in '*?[')
+
+def isExactPattern(pattern):
+    return not any(c in pattern for c in '*?[')
+
+
+class PrefixTrie(object):
+    # Character trie, values are stored in the node of the last prefix character
+
+    def __init__(self):
+        self.root = dict()
+        self.size = 0
+
+    def add(self, prefix, value):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, dict())
+        node.setdefault(None, []).append(value)
+        self.size += 1
+
+    def remove(self, prefix, value):
+        path, node = [], self.root
+        for c in prefix:
+            path.append((node, c))
+            node = node.get(c)
+            if node is None:
+                return
+        values = node.get(None, [])
+        if value in values:
+            values.remove(value)
+            self.size -= 1
+        if len(values) == 0:
+            node.pop(None, None)
+        # Remove empty nodes
+        for parent, c in reversed(path):
+            if len(parent[c]) > 0:
+                break
+            del parent[c]
+
+    def match(self, s):
+        # Values of all prefixes of the string
+        node, found = self.root, []
+        found.extend(node.get(None, ()))
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class CapcodeFilter(object):
+
+    def __init__(self, patterns=None, cache_size=4096):
+        self.patterns = []
+        self.exact = set()
+        self.prefixes = PrefixTrie()
+        self.regex = None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.compile(patterns or [])
+
+    def compile(self, patterns):
+        exact, prefixes, others = set(), PrefixTrie(), []
+        for pattern in patterns:
+            if isExactPattern(pattern):
+                exact.add(pattern)
+            elif isPrefixPattern(pattern):
+                prefixes.add(pattern[:-1], True)
+            else:
+                others.append(fnmatch.translate(pattern))
+        regex = re.compile("|".join("(?:{})".format(rx) for rx in others)) if len(others) > 0 else None
+        with self.lock:
+            self.patterns = list(patterns)
+            self.exact, self.prefixes, self.regex = exact, prefixes, regex
+            self.cache.clear()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def matches(self, capcode):
+        # Without patterns the filter is disabled: everything passes
+        if len(self.patterns) == 0:
+            return True
+
+        with self.lock:
+            result = self.cache.get(capcode)
+            if result is not None:
+                self.cache.move_to_end(capcode)
+                return result
+
+            result = capcode in self.exact or len(self.prefixes.match(capcode)) > 0 or \
+                     (self.regex is not None and self.regex.match(capcode) is not None)
+            self.cache[capcode] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
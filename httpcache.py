@@ -0,0 +1,130 @@
+# HTTP helpers: gzip negotiation and the static files cache
+#
+# Static files are read and gzip-compressed once, at the first request, and
+# kept in memory with their content type and ETag until the file changes.
+# Dynamic responses are compressed per request with a faster compression level.
+
+import os
+import gzip
+import zlib
+import threading
+
+CONTENT_TYPES = {
+    '.css': 'text/css',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.gif': 'image/gif',
+    '.htm': 'text/html',
+    '.html': 'text/html',
+    '.ico': 'image/x-icon',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpg',
+    '.js': 'text/javascript',
+    '.png': 'image/png',
+    '.svg': 'image/svg',
+    '.text': 'text/plain',
+    '.ttf': 'font/ttf',
+    '.txt': 'text/plain',
+    '.woff': 'application/font-woff',
+    '.woff2': 'font/woff2'
+}
+
+# Already compressed formats (images, woff fonts) are sent as they are
+COMPRESSIBLE_EXT = {'.css', '.htm', '.html', '.js', '.json', '.svg', '.text', '.txt', '.ttf', '.eot', '.ico'}
+
+
+def contentType(path):
+    # Content type by the file extension, or None if files of this type are not served
+    return CONTENT_TYPES.get(os.path.splitext(path)[1].lower())
+
+
+def acceptsGzip(accept_encoding):
+    # "Accept-Encoding: gzip, deflate, br" or "gzip;q=0.5", q=0 means "not acceptable"
+    if not accept_encoding:
+        return False
+    for item in accept_encoding.split(','):
+        fields = item.strip().split(';')
+        if fields[0].strip().lower() not in ("gzip", "*"):
+            continue
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzipBytes(data, level):
+    # mtime=0: the same data always gives the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class StaticFile(object):
+    __slots__ = ['content', 'gzip', 'content_type', 'etag', 'mtime', 'size']
+
+    def __init__(self, content, gzip_content, content_type, mtime, size):
+        self.content = content
+        self.gzip = gzip_content
+        self.content_type = content_type
+        # Strong validator from the content, it does not change if the file is only copied again
+        self.etag = '"{:x}-{:08x}"'.format(len(content), zlib.crc32(content))
+        self.mtime = mtime
+        self.size = size
+
+    def modified(self):
+        # Last modification time, seconds
+        return self.mtime/1e9
+
+
+class StaticFileCache(object):
+
+    def __init__(self, root, gzip_level=9, max_file_size=4*1024*1024):
+        self.root = os.path.abspath(root)
+        self.gzip_level = gzip_level
+        self.max_file_size = max_file_size
+        self.files = dict()
+        self.lock = threading.Lock()
+
+    def filePath(self, url_path):
+        # Absolute file path, or None if the path is outside of the root folder
+        path = os.path.normpath(os.path.join(self.root, url_path.lstrip('/')))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def get(self, url_path):
+        # StaticFile or None if the file can not be read
+        path = self.filePath(url_path)
+        if path is None or contentType(path) is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.files.get(path)
+        if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+            return entry
+
+        try:
+            with open(path, 'rb') as datafile:
+                content = datafile.read()
+        except OSError as e:
+            print("Static file read error: %s" % str(e))
+            return None
+        gzip_content = None
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXT:
+            gzip_content = gzipBytes(content, self.gzip_level)
+            if len(gzip_content) >= len(content):
+                gzip_content = None
+        entry = StaticFile(content, gzip_content, contentType(path), st.st_mtime_ns, st.st_size)
+        # Big files are not kept in memory
+        if st.st_size <= self.max_file_size:
+            with self.lock:
+                self.files[path] = entry
+        return entry
+
+    def __len__(self):
+        return len(self.files)
@@ -0,0 +1,59 @@
+# HTTP server with a fixed pool of worker threads
+#
+# The accepting thread only puts new connections into a bounded queue, the
+# requests are handled by the workers in parallel. If all workers are busy and
+# the queue is full, new connections wait in the socket backlog.
+
+import queue
+import threading
+from http.server import HTTPServer
+
+
+class PooledHTTPServer(HTTPServer):
+    # Listen backlog: with the default (5) a burst of new connections gets SYN retries of 1s
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, workers=8, queue_size=32):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.workers = []
+        self.busy = 0
+        self.busy_lock = threading.Lock()
+        for n in range(workers):
+            worker = threading.Thread(target=self.workerThreadFunc, name="http-{}".format(n))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        # Called by serve_forever() for each new connection
+        self.requests.put((request, client_address))
+
+    def workerThreadFunc(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            with self.busy_lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.busy_lock:
+                    self.busy -= 1
+
+    def pending(self):
+        # Connections waiting for a free worker
+        return self.requests.qsize()
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        for worker in self.workers:
+            try:
+                self.requests.put_nowait(None)
+            except queue.Full:
+                break
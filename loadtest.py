@@ -0,0 +1,98 @@
+# HTTP load test for the receiver web server
+#
+# To run: python3 loadtest.py --host 192.168.1.10 --clients 20 --requests 50
+# Optional slow clients download /api/messages at a low speed, like dashboards
+# on a bad mobile link, to check that they do not block the other clients.
+
+import time
+import socket
+import argparse
+import threading
+import http.client
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values)*p/100))]
+
+
+def clientThreadFunc(host, port, paths, count, use_gzip, latencies, errors, lock):
+    headers = {"Accept-Encoding": "gzip"} if use_gzip else {}
+    for n in range(count):
+        path = paths[n % len(paths)]
+        time_start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            with lock:
+                if resp.status in (200, 304):
+                    latencies.append(time.perf_counter() - time_start)
+                else:
+                    errors.append(resp.status)
+        except (OSError, http.client.HTTPException) as e:
+            with lock:
+                errors.append(str(e))
+
+
+def slowClientThreadFunc(host, port, path, bytes_per_s, stop):
+    # Reads the response in small pieces, holding the connection for a long time
+    try:
+        sock = socket.create_connection((host, port), timeout=60)
+        sock.sendall("GET {} HTTP/1.0\r\nHost: {}\r\n\r\n".format(path, host).encode("ascii"))
+        while not stop.is_set():
+            if len(sock.recv(max(1, bytes_per_s//10))) == 0:
+                break
+            time.sleep(0.1)
+        sock.close()
+    except OSError:
+        pass
+
+
+def loadTest(host, port, paths, clients, requests, slow_clients, use_gzip):
+    stop = threading.Event()
+    slow_threads = []
+    for n in range(slow_clients):
+        t = threading.Thread(target=slowClientThreadFunc, args=(host, port, "/api/messages", 1024, stop))
+        t.daemon = True
+        t.start()
+        slow_threads.append(t)
+    time.sleep(0.5 if slow_clients > 0 else 0)
+
+    latencies, errors, lock = [], [], threading.Lock()
+    threads = []
+    time_start = time.perf_counter()
+    for n in range(clients):
+        t = threading.Thread(target=clientThreadFunc, args=(host, port, paths, requests, use_gzip, latencies, errors, lock))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - time_start
+    stop.set()
+
+    latencies.sort()
+    print("Clients: {}, slow clients: {}, requests: {}, errors: {}, time: {:.2f}s, {:.1f} requests/s".format(
+          clients, slow_clients, len(latencies), len(errors), elapsed, len(latencies)/elapsed if elapsed > 0 else 0))
+    print("Latency: p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+          1000*percentile(latencies, 50), 1000*percentile(latencies, 90),
+          1000*percentile(latencies, 99), 1000*(latencies[-1] if len(latencies) > 0 else 0)))
+    if len(errors) > 0:
+        print("Errors:", errors[:10])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", dest="host", default="localhost")
+    parser.add_argument("--port", dest="port", type=int, default=8000)
+    parser.add_argument("--clients", dest="clients", type=int, default=20)
+    parser.add_argument("--requests", dest="requests", type=int, default=50, help="Requests per client")
+    parser.add_argument("--slow", dest="slow", type=int, default=0, help="Slow clients downloading /api/messages")
+    parser.add_argument("--paths", dest="paths", default="/api/messages?limit=100,/api/stats,/,/icons/css/all.css",
+                        help="Comma-separated list of requested paths")
+    parser.add_argument("--gzip", dest="gzip", action="store_true")
+    args = parser.parse_args()
+    loadTest(args.host, args.port, args.paths.split(','), args.clients, args.requests, args.slow, args.gzip)
@@ -0,0 +1,208 @@
+# Received message, kept in memory in a compact form
+#
+# Capcodes are stored as integers in an array and the time as epoch seconds,
+# the receivers text (with capcode descriptions) and the timestamp string are
+# rendered only when needed. The raw multimon-ng line is optional, it adds
+# about 40% to the message size.
+#
+# Memory report: python3 message.py [--count=100000] [--file=capture.log] [--raw]
+
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+from array import array
+import msgparser
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parseTimestamp(value):
+    # "YYYY-mm-dd HH:MM:SS" (local time) or epoch seconds => epoch seconds
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(time.mktime((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, 0, -1)))
+    except (TypeError, ValueError, OverflowError):
+        return int(time.time())
+
+
+def formatTimestamp(epoch):
+    return time.strftime(TIME_FORMAT, time.localtime(epoch))
+
+
+def capcodeToText(protocol, capcode):
+    # FLEX capcodes are always shown with 9 digits
+    return "{:09d}".format(capcode) if protocol == msgparser.PROTOCOL_FLEX else str(capcode)
+
+
+class MessageItem(object):
+    __slots__ = ['id', 'protocol', 'epoch', 'epoch_max', 'timereceived', 'groupid', 'capcodes', 'body', 'priority', 'sender', 'is_posted', 'message_raw', 'json_cache']
+
+    # Capcode descriptions for the receivers text, set by the app after loading capcodes
+    capcodeIndex = None
+
+    def __init__(self, protocol=msgparser.PROTOCOL_FLEX):
+        self.id = None
+        self.protocol = protocol
+        self.epoch = int(time.time())
+        self.epoch_max = 0  # the latest time of this and older stored messages, set by the store
+        self.timereceived = time.monotonic()
+        self.groupid = ""
+        self.capcodes = array('I')
+        self.body = ""
+        self.priority = 0
+        self.sender = 0
+        self.is_posted = False
+        self.message_raw = None
+        self.json_cache = None
+
+    @property
+    def timestamp(self):
+        return formatTimestamp(self.epoch)
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self.epoch = parseTimestamp(value)
+
+    def capcodesText(self):
+        return [capcodeToText(self.protocol, capcode) for capcode in self.capcodes]
+
+    @property
+    def receivers(self):
+        # "Description (capcode), capcode, ...", descriptions are shown for FLEX capcodes only
+        index = MessageItem.capcodeIndex if self.protocol == msgparser.PROTOCOL_FLEX else None
+        names = []
+        for capcode in self.capcodes:
+            text = capcodeToText(self.protocol, capcode)
+            info = index.lookup(capcode) if index is not None else None
+            names.append("{} ({})".format(info.description, text) if info is not None and len(info.description) > 0 else text)
+        return ", ".join(names)
+
+    def addCapcode(self, capcode):
+        # False if the capcode is already there
+        if capcode in self.capcodes:
+            return False
+        self.capcodes.append(capcode)
+        return True
+
+    def toDict(self):
+        return {"id": self.id,
+                "protocol": self.protocol,
+                "timestamp": self.timestamp,
+                "timereceived": self.timereceived,
+                "groupid": self.groupid,
+                "receivers": self.receivers,
+                "capcodes": self.capcodesText(),
+                "body": self.body,
+                "priority": self.priority,
+                "sender": self.sender,
+                "message_raw": self.message_raw if self.message_raw is not None else "",
+                "is_posted": self.is_posted}
+
+    @classmethod
+    def fromDict(cls, data):
+        # Older records have no protocol: POCSAG sender types are 64 and more (see p2000.py)
+        protocol = data.get("protocol")
+        if protocol is None:
+            protocol = msgparser.PROTOCOL_POCSAG if data.get("sender", 0) >= 64 else msgparser.PROTOCOL_FLEX
+        msg = cls(protocol)
+        msg.id = data.get("id")
+        if "timestamp" in data:
+            msg.epoch = parseTimestamp(data["timestamp"])
+        msg.groupid = sys.intern(data["groupid"]) if isinstance(data.get("groupid"), str) else data.get("groupid", "")
+        for capcode in data.get("capcodes", []):
+            try:
+                msg.addCapcode(int(capcode))
+            except (TypeError, ValueError, OverflowError):
+                pass
+        msg.body = data.get("body", "")
+        msg.priority = data.get("priority", 0)
+        msg.sender = data.get("sender", 0)
+        msg.message_raw = data.get("message_raw") or None
+        msg.is_posted = data.get("is_posted", True)
+        return msg
+
+    def toJSONBytes(self):
+        # Compact JSON, encoded once. Should be called with the messages lock held
+        if self.json_cache is None:
+            self.json_cache = json.dumps(self.toDict(), sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+        return self.json_cache
+
+    def toJSON(self):
+        return self.toJSONBytes().decode("utf-8")
+
+    def invalidate(self):
+        # Message was changed (merged or posted), should be called with the messages lock held
+        self.json_cache = None
+
+    def postToServer(self):
+        try:
+            print("POST:", self.toJSON())
+            # r = requests.post("http://mysuperserver.com", data=dict(payload=self.toJSON()))
+            # print("POST result:", r.status_code, r.reason)
+            # print("POST text:", r.text)
+            self.is_posted = True
+        except:
+            pass
+
+    def isPosted(self):
+        return self.is_posted
+
+
+# Memory report
+
+def messageFromLine(parsed, keep_raw):
+    msg = MessageItem(parsed.protocol)
+    if parsed.timestamp is not None:
+        msg.epoch = parseTimestamp(parsed.timestamp)
+    msg.groupid = sys.intern(parsed.groupid) if isinstance(parsed.groupid, str) else parsed.groupid
+    for capcode in parsed.capcodes:
+        try:
+            msg.addCapcode(int(capcode))
+        except ValueError:
+            pass
+    msg.body = parsed.body
+    msg.message_raw = parsed.raw if keep_raw else None
+    return msg
+
+
+def memoryReport(count, filename, keep_raw):
+    if filename is not None:
+        with open(filename, "r", encoding="utf-8", errors="replace") as f:
+            samples = [line for line in f if msgparser.parseLine(line) is not None]
+    else:
+        samples = [line for line in msgparser.BENCH_SAMPLES if msgparser.parseLine(line) is not None]
+    if len(samples) == 0:
+        print("No messages in the input")
+        return
+
+    # Lines are made unique, like real messages; only the memory kept by messages is counted
+    tracemalloc.start()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    items = []
+    for p in range(count):
+        line = samples[p % len(samples)].rstrip("\n") + " #{}".format(p)
+        msg = messageFromLine(msgparser.parseLine(line), keep_raw)
+        msg.id = p + 1
+        items.append(msg)
+    mem_items = tracemalloc.get_traced_memory()[0]
+    for msg in items:
+        msg.toJSONBytes()
+    mem_json = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("Messages: {}, raw lines: {}".format(count, "yes" if keep_raw else "no"))
+    print("Memory: {:.0f} bytes/message, {:.1f}MB".format((mem_items - mem_start)/count, (mem_items - mem_start)/1e6))
+    print("With cached JSON: {:.0f} bytes/message, {:.1f}MB".format((mem_json - mem_start)/count, (mem_json - mem_start)/1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", dest="count", type=int, default=100000)
+    parser.add_argument("--file", dest="file", default=None, help="multimon-ng output to take the messages from")
+    parser.add_argument("--raw", dest="raw", action="store_true", help="Keep raw lines")
+    args = parser.parse_args()
+    memoryReport(args.count, args.file, args.raw)
@@ -0,0 +1,286 @@
+# Secondary indexes over the messages store, used by the /api/messages query
+#
+# Posting lists (ids in ascending order) are kept per capcode and per sender
+# and updated on insert, merge and eviction. Ids grow with insertion, so the
+# store itself is the id index. Message times (FLEX decoder timestamps, clock
+# time for POCSAG) are not ordered by id, but their running maximum is: the
+# first id of a "from" range is found by binary search over it, and every
+# candidate is checked against the range.
+#
+# TextIndex is an inverted index over message bodies for /api/search.
+
+import re
+import time
+import heapq
+from collections import deque
+from capindex import capcodeToInt
+
+
+class PostingLists(object):
+
+    def __init__(self):
+        self.lists = dict()
+
+    def add(self, key, msg_id):
+        ids = self.lists.get(key)
+        if ids is None:
+            ids = deque()
+            self.lists[key] = ids
+        if len(ids) == 0 or ids[-1] < msg_id:
+            ids.append(msg_id)
+            return
+        # Merged into a recent message: insert near the end
+        pos = len(ids)
+        while pos > 0 and ids[pos - 1] > msg_id:
+            pos -= 1
+        if pos == 0 or ids[pos - 1] != msg_id:
+            ids.insert(pos, msg_id)
+
+    def remove(self, key, msg_id):
+        ids = self.lists.get(key)
+        if ids is None:
+            return
+        if len(ids) > 0 and ids[0] == msg_id:
+            ids.popleft()
+        elif len(ids) > 0 and ids[-1] == msg_id:
+            ids.pop()
+        else:
+            try:
+                ids.remove(msg_id)
+            except ValueError:
+                pass
+        if len(ids) == 0:
+            del self.lists[key]
+
+    def get(self, key):
+        return self.lists.get(key, ())
+
+    def __len__(self):
+        return len(self.lists)
+
+
+TIME_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+
+
+def parseTime(value):
+    # Epoch seconds or "YYYY-mm-dd HH:MM:SS" (local time, like message timestamps), ValueError if not valid
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+    if seconds is not None:
+        if seconds != seconds or seconds in (float("inf"), float("-inf")):
+            raise ValueError("Invalid time: {}".format(value))
+        return seconds
+    if TIME_REGEX.fullmatch(value) is None:
+        raise ValueError("Invalid time: {}".format(value))
+    try:
+        return time.mktime(time.strptime(value.replace('T', ' '), "%Y-%m-%d %H:%M:%S"))
+    except (ValueError, OverflowError):
+        raise ValueError("Invalid time: {}".format(value))
+
+
+class MessageIndex(object):
+
+    def __init__(self):
+        self.by_capcode = PostingLists()
+        self.by_sender = PostingLists()
+
+    def add(self, msg):
+        for capcode in msg.capcodes:
+            self.by_capcode.add(capcode, msg.id)
+        self.by_sender.add(msg.sender, msg.id)
+
+    def addCapcode(self, msg, capcode):
+        self.by_capcode.add(capcode, msg.id)
+
+    def changeSender(self, msg, old_sender):
+        if old_sender != msg.sender:
+            self.by_sender.remove(old_sender, msg.id)
+            self.by_sender.add(msg.sender, msg.id)
+
+    def remove(self, msg):
+        for capcode in msg.capcodes:
+            self.by_capcode.remove(capcode, msg.id)
+        self.by_sender.remove(msg.sender, msg.id)
+
+    def query(self, store, since_id=None, time_from=None, time_to=None,
+              capcode=None, priority=None, sender=None, limit=None, before_id=None):
+        # Matching messages, newest first. Should be called with the store lock held
+        result = []
+        if limit is not None and limit <= 0:
+            return result
+
+        # Id range [id_min, id_max] from the id and time limits
+        id_min = since_id + 1 if since_id is not None else 0
+        id_max = store.last_id if before_id is None else min(store.last_id, before_id - 1)
+        if time_from is not None:
+            time_from = parseTime(time_from)
+            # Older messages are older than their running maximum too
+            pos = self.timePosition(store, time_from)
+            if pos >= len(store):
+                return result
+            id_min = max(id_min, store.at(pos).id)
+        if time_to is not None:
+            time_to = parseTime(time_to)
+        if id_min > id_max:
+            return result
+
+        # Capcodes are stored as numbers
+        if capcode is not None:
+            capcode = capcodeToInt(capcode)
+            if capcode is None:
+                return result
+
+        # Candidates: the shortest posting list, or the store range
+        candidates = None
+        if capcode is not None:
+            candidates = self.by_capcode.get(capcode)
+        if sender is not None:
+            sender_ids = self.by_sender.get(sender)
+            if candidates is None or len(sender_ids) < len(candidates):
+                candidates = sender_ids
+
+        def isMatch(msg):
+            return (time_from is None or msg.epoch >= time_from) and \
+                   (time_to is None or msg.epoch <= time_to) and \
+                   (priority is None or msg.priority == priority) and \
+                   (sender is None or msg.sender == sender) and \
+                   (capcode is None or capcode in msg.capcodes)
+
+        if candidates is not None:
+            for msg_id in reversed(candidates):
+                if msg_id > id_max:
+                    continue
+                if msg_id < id_min:
+                    break
+                msg = store.getById(msg_id)
+                if msg is not None and isMatch(msg):
+                    result.append(msg)
+                    if limit is not None and len(result) >= limit:
+                        break
+            return result
+
+        pos = store.positionOf(id_max + 1) - 1
+        pos_min = store.positionOf(id_min)
+        while pos >= pos_min:
+            msg = store.at(pos)
+            if isMatch(msg):
+                result.append(msg)
+                if limit is not None and len(result) >= limit:
+                    break
+            pos -= 1
+        return result
+
+    def timePosition(self, store, value):
+        # Position of the first message with the running maximum time >= value
+        lo, hi = 0, len(store)
+        while lo < hi:
+            mid = (lo + hi)//2
+            if store.at(mid).epoch_max < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+TOKEN_REGEX = re.compile(r"\w+")
+QUERY_TERM_REGEX = re.compile(r"\w+\*?")  # words of the query, "word*" for a prefix
+MIN_PREFIX_LEN = 2  # also the vocabulary bucket key length
+SHORT_LIST_LEN = 16  # posting lists of a prefix up to this length are merged at once
+
+
+def tokenize(text):
+    return set(TOKEN_REGEX.findall(text.lower()))
+
+
+def uniqueIds(ids):
+    # Sorted ids without repeats
+    last = None
+    for msg_id in ids:
+        if msg_id != last:
+            yield msg_id
+            last = msg_id
+
+
+class TextIndex(object):
+    # Words of message bodies => ids, plus the vocabulary for prefix search.
+    # Vocabulary sets by the first letters: a new word (every rit number is one) is added in O(1)
+
+    def __init__(self):
+        self.postings = PostingLists()
+        self.words = dict()  # first MIN_PREFIX_LEN letters => words
+
+    def add(self, msg):
+        for word in tokenize(msg.body):
+            if word not in self.postings.lists:
+                self.words.setdefault(word[:MIN_PREFIX_LEN], set()).add(word)
+            self.postings.add(word, msg.id)
+
+    def remove(self, msg):
+        for word in tokenize(msg.body):
+            self.postings.remove(word, msg.id)
+            if word not in self.postings.lists:
+                bucket = self.words.get(word[:MIN_PREFIX_LEN])
+                if bucket is not None:
+                    bucket.discard(word)
+                    if len(bucket) == 0:
+                        del self.words[word[:MIN_PREFIX_LEN]]
+
+    def prefixWords(self, prefix):
+        return [word for word in self.words.get(prefix[:MIN_PREFIX_LEN], ()) if word.startswith(prefix)]
+
+    def termIds(self, term):
+        # Ids of a query term, newest first: "word" or "prefix*".
+        # Long posting lists of a prefix are merged lazily, the search stops at the limit. Short ones
+        # (rare words, like rit numbers) are joined at once: a heap of thousands of them costs more
+        if not term.endswith('*'):
+            return reversed(self.postings.get(term))
+        short, lists = [], []
+        for word in self.prefixWords(term[:-1]):
+            ids = self.postings.get(word)
+            if len(ids) <= SHORT_LIST_LEN:
+                short.append(ids)
+            else:
+                lists.append(reversed(ids))
+        if len(short) > 0:
+            lists.append(iter(sorted(set().union(*short), reverse=True)))
+        return uniqueIds(heapq.merge(*lists, reverse=True))
+
+    def termSize(self, term):
+        if not term.endswith('*'):
+            return len(self.postings.get(term))
+        return sum(len(self.postings.get(word)) for word in self.prefixWords(term[:-1]))
+
+    def search(self, store, query, limit=100):
+        # Messages with all query words (AND), newest first. Should be called with the store lock held
+        # Split like message bodies: "BDH-02" is "bdh" and "02", punctuation is ignored
+        terms = list(set(QUERY_TERM_REGEX.findall(query.lower())))
+        for term in terms:
+            if term.endswith('*') and len(term) - 1 < MIN_PREFIX_LEN:
+                raise ValueError("Prefix '{}' is too short, at least {} letters".format(term, MIN_PREFIX_LEN))
+        if len(terms) == 0 or (limit is not None and limit <= 0):
+            return []
+
+        # Start from the rarest term, check the others in the message text
+        if len(terms) > 1:
+            terms.sort(key=self.termSize)
+        result = []
+        for msg_id in self.termIds(terms[0]):
+            msg = store.getById(msg_id)
+            if msg is None:
+                continue
+            if len(terms) > 1:
+                words = tokenize(msg.body)
+                if not all(self.hasTerm(words, t) for t in terms[1:]):
+                    continue
+            result.append(msg)
+            if limit is not None and len(result) >= limit:
+                break
+        return result
+
+    def hasTerm(self, words, term):
+        if term.endswith('*'):
+            prefix = term[:-1]
+            return any(w.startswith(prefix) for w in words)
+        return term in words
@@ -0,0 +1,148 @@
+# Persistent append-only messages log
+#
+# Messages are written as JSON lines into segment files (00000001.jsonl, ...)
+# by a background thread. Writes are batched and fsync'ed once per flush
+# interval to keep SD-card wear low. Old segments are deleted when the newer
+# ones already hold enough records to restore the messages list.
+
+import os
+import json
+import threading
+
+SEGMENT_EXT = ".jsonl"
+
+
+class MessageLog(object):
+
+    def __init__(self, directory, keep_records, segment_size=1024*1024, flush_interval_s=30.0):
+        self.directory = directory
+        self.keep_records = keep_records
+        self.segment_size = segment_size
+        self.flush_interval_s = flush_interval_s
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # flush() is called by the writer thread, and before reboot
+        self.pending = []
+        self.segments = []  # [number, records count, size], oldest first
+        self.is_active = False
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.written = 0
+        self.flushes = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            base, ext = os.path.splitext(name)
+            if ext == SEGMENT_EXT and base.isdigit():
+                self.segments.append([int(base), None, os.path.getsize(self.segmentPath(int(base)))])
+        # The last record can be incomplete after power loss, don't append to it
+        self.needs_newline = False
+        if len(self.segments) > 0 and self.segments[-1][2] > 0:
+            with open(self.segmentPath(self.segments[-1][0]), "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                self.needs_newline = f.read(1) != b"\n"
+
+    def segmentPath(self, number):
+        return os.path.join(self.directory, "{:08d}{}".format(number, SEGMENT_EXT))
+
+    def load(self, limit):
+        # Newest records (dicts, oldest first), segments older than needed are deleted
+        chunks, count = [], 0
+        for seg in reversed(self.segments):
+            if count >= limit:
+                break
+            records = []
+            try:
+                with open(self.segmentPath(seg[0]), "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # Last line can be incomplete after power loss
+                            pass
+            except OSError as e:
+                print("Message log read error: {}".format(e))
+            seg[1] = len(records)
+            chunks.append(records)
+            count += len(records)
+        self.prune()
+
+        result = []
+        for records in reversed(chunks):
+            result.extend(records)
+        return result[-limit:] if limit > 0 else []
+
+    def segmentCount(self, seg):
+        if seg[1] is None:
+            try:
+                with open(self.segmentPath(seg[0]), "rb") as f:
+                    seg[1] = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(65536), b""))
+            except OSError:
+                seg[1] = 0
+        return seg[1]
+
+    def prune(self):
+        # Delete the oldest segments, if the newer ones have enough records
+        while len(self.segments) > 1:
+            newer_count = sum(self.segmentCount(seg) for seg in self.segments[1:])
+            if newer_count < self.keep_records:
+                break
+            try:
+                os.remove(self.segmentPath(self.segments[0][0]))
+            except OSError as e:
+                print("Message log delete error: {}".format(e))
+            del self.segments[0]
+
+    def append(self, record):
+        # Queue the record (dict), it will be written by the background thread
+        with self.lock:
+            self.pending.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+
+    def start(self):
+        self.is_active = True
+        self.thread = threading.Thread(target=self.writerThreadFunc)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.is_active = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def writerThreadFunc(self):
+        while self.is_active:
+            self.wakeup.wait(self.flush_interval_s)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            self.writePending()
+
+    def writePending(self):
+        with self.lock:
+            lines, self.pending = self.pending, []
+        if len(lines) == 0:
+            return
+
+        # New segment, if there is no one or the current one is full
+        if len(self.segments) == 0 or self.segments[-1][2] >= self.segment_size:
+            number = self.segments[-1][0] + 1 if len(self.segments) > 0 else 1
+            self.segments.append([number, 0, 0])
+            self.prune()
+        seg = self.segments[-1]
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        if self.needs_newline and seg[2] > 0:
+            data = b"\n" + data
+        self.needs_newline = False
+        try:
+            with open(self.segmentPath(seg[0]), "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            seg[1] = self.segmentCount(seg) + len(lines)
+            seg[2] += len(data)
+            self.written += len(lines)
+            self.flushes += 1
+        except OSError as e:
+            print("Message log write error: {}".format(e))
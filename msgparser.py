@@ -0,0 +1,122 @@
+# multimon-ng output parser: FLEX (old and new formats) and POCSAG lines
+#
+# Every line is parsed in a single pass into a compact ParsedLine record,
+# lines that are not messages (headers, BIN frames, etc) give None.
+#
+# Benchmark: python3 msgparser.py [--lines=1000000]
+
+import time
+import argparse
+
+PROTOCOL_FLEX = 1
+PROTOCOL_POCSAG = 2
+
+# POCSAG payload format
+POCSAG_EMPTY = 0
+POCSAG_ALPHA = 1
+POCSAG_NUMERIC = 2
+
+
+class ParsedLine(object):
+    __slots__ = ['protocol', 'timestamp', 'groupid', 'capcodes', 'body', 'format', 'raw']
+
+    def __init__(self, protocol, timestamp, groupid, capcodes, body, format, raw):
+        self.protocol = protocol
+        self.timestamp = timestamp
+        self.groupid = groupid
+        self.capcodes = capcodes
+        self.body = body
+        self.format = format
+        self.raw = raw
+
+    def __repr__(self):
+        return "ParsedLine({}, {}, {}, {}, {!r})".format(self.protocol, self.timestamp, self.groupid, self.capcodes, self.body)
+
+
+def parseFlex(line):
+    if line[4:5] == '|':
+        # New multimon-ng version
+        # FLEX|2020-10-17 08:18:37|1600/2/K/A|04.093|002029568 000120999 000120342|ALN|A2 13342 Rit 92107 Amsterdam Carolina MacGillavrylaan 1098XB
+        fields = line.split('|', 6)
+        if len(fields) < 7 or fields[5] not in ('ALN', 'NUM'):
+            return None
+        return ParsedLine(PROTOCOL_FLEX, fields[1], fields[3].strip(), fields[4].split(), fields[6].strip(), fields[5], line)
+
+    # Old multimon-ng version
+    # FLEX: 2018-07-29 11:43:27 1600/2/K/A 10.120 [001523172] ALN A1 Boerhaavelaan HAARLM : 16172
+    # FLEX: 2020-10-17 18:40:19 1600/2/A 10.020 [001530615] NUM 3301
+    fields = line.split(' ', 7)
+    if len(fields) < 7:
+        return None
+    msg_type = fields[6]
+    if msg_type not in ('ALN', 'NUM'):
+        return None
+    body = fields[7].strip() if len(fields) > 7 else ""
+    return ParsedLine(PROTOCOL_FLEX, fields[1] + " " + fields[2], fields[4].strip(), fields[5].strip('[]').split(), body, msg_type, line)
+
+
+def parsePocsag(line):
+    # POCSAG1200: Address:  104206  Function: 3  Alpha:   CompaxoHybridO|[Onderwerp:]Min. afw. ruimtetemp.-H: Vriescel 2042|[Inhoud:]<EOT><EOT>
+    # POCSAG1200: Address:    1000  Function: 3
+    # POCSAG1200: Address:  175557  Function: 0  Numeric: 0715828347
+    addr_index = line.find("Address:")
+    if addr_index == -1:
+        return None
+    func_index = line.find("Function:", addr_index)
+    if func_index == -1:
+        return None
+    receiver = line[addr_index + 8:func_index].strip()
+    body, fmt = "-", POCSAG_EMPTY
+    payload_index = line.find(":", func_index + 9)
+    if payload_index != -1:
+        payload_type = line[func_index + 9:payload_index].split()
+        if payload_type and payload_type[-1] == "Alpha":
+            fmt, body = POCSAG_ALPHA, line[payload_index + 1:].strip()
+        elif payload_type and payload_type[-1] == "Numeric":
+            fmt, body = POCSAG_NUMERIC, line[payload_index + 1:].strip()
+    if body == "-":
+        fmt = POCSAG_EMPTY
+    return ParsedLine(PROTOCOL_POCSAG, None, 0, [receiver], body, fmt, line)
+
+
+def parseLine(line):
+    # Parse one decoded line of multimon-ng output, returns ParsedLine or None
+    line = line.rstrip("\r\n")
+    if line.startswith('FLEX'):
+        return parseFlex(line)
+    if line.startswith('POCSAG'):
+        return parsePocsag(line)
+    return None
+
+
+# Benchmark
+
+BENCH_SAMPLES = [
+    "FLEX: 2018-07-29 11:43:27 1600/2/K/A 10.120 [001523172] ALN A1 Boerhaavelaan HAARLM : 16172\n",
+    "FLEX: 2020-10-17 18:40:19 1600/2/A 10.020 [001530615] NUM 3301\n",
+    "FLEX|2020-10-17 08:18:37|1600/2/K/A|04.093|002029568 000120999 000120342|ALN|A2 13342 Rit 92107 Amsterdam Carolina MacGillavrylaan 1098XB\n",
+    "FLEX|2020-10-17 08:18:40|1600/2/K/A|04.095|001420999|ALN|P 1 BDH-02 Buitenbrand Stationsplein Rotterdam 171531\n",
+    "FLEX|2020-10-17 08:18:41|1600/2/K/A|04.096|001420999|BIN|3A7F0000\n",
+    "POCSAG1200: Address:  104206  Function: 3  Alpha:   CompaxoHybridO|[Onderwerp:]Min. afw. ruimtetemp.-H: Vriescel 2042|[Inhoud:]<EOT><EOT>\n",
+    "POCSAG1200: Address:    1000  Function: 3\n",
+    "POCSAG1200: Address:  175557  Function: 0  Numeric: 0715828347\n",
+    "Enabled demodulators: FLEX POCSAG512 POCSAG1200 POCSAG2400\n",
+]
+
+
+def benchmark(lines_count):
+    corpus = [BENCH_SAMPLES[p % len(BENCH_SAMPLES)] for p in range(lines_count)]
+    parsed = 0
+    t_start = time.perf_counter()
+    for line in corpus:
+        if parseLine(line) is not None:
+            parsed += 1
+    t_total = time.perf_counter() - t_start
+    print("Parsed {} of {} lines in {:.3f}s: {:.0f} lines/sec".format(parsed, lines_count, t_total, lines_count/t_total))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", dest="lines", type=int, default=1000000)
+    args = parser.parse_args()
+    benchmark(args.lines)
@@ -14,17 +14,33 @@ import sys
 import subprocess
 import os
 import threading
-import re
-import fnmatch
+import queue
 import textwrap
 import json
 import argparse
+import urllib.parse
+import _thread
+import signal
+import email.utils
 import requests
-from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler
 from websocket_server import WebsocketServer
 import libTFT
+import msgparser
 import utils
+from priority import PriorityClassifier
+from stats import PipelineStats
+from dedup import TimedIndex
+from store import MessageStore
+from filters import CapcodeFilter
+from capindex import CapcodeIndex, capcodeToInt
+from msglog import MessageLog
+from msgindex import MessageIndex, TextIndex, parseTime
+from httpcache import StaticFileCache, acceptsGzip, gzipBytes, contentType
+from httpserver import PooledHTTPServer
+from message import MessageItem, parseTimestamp
+from subscriptions import SubscriptionIndex, parseSubscription
+import replay
 
 # Main parameters
 frequency = "169.65M"  # FLEX
@@ -32,16 +48,41 @@ frequency = "169.65M"  # FLEX
 gain = 20           # gain, een getal tussen 0-50
 correction = 0      # specifieke ppm-afwijking van RTL-SDR
 device = 0          # device id, can be used if >1 receivers connected
+devices = []        # (device id, frequency) of all receivers in use, see --device
+duplicate_window_s = 10.0  # the same message from another receiver in this time is a duplicate
+merge_window_s = 60.0      # the same text in this time is one message sent to several capcodes
 messagesLimit = 5000
+keep_raw_lines = False     # multimon-ng lines of messages (message_raw), ~40% more memory per message
+ingestQueueLimit = 10000  # lines from multimon-ng waiting to be processed, new lines are dropped if full
+ingestBatchLimit = 100
 no_lcd = False
 debug = False
+replay_file = None  # recorded multimon-ng output, used instead of the receiver
+replay_speed = None
+replay_exit = False  # exit when the replay file is finished (benchmarks, tests)
 
 # Internal server
 PORT_NUMBER = 8000
+http_workers = 8             # requests handled in parallel, a slow client blocks only one worker
 httpd = None
+gzip_json_level = 1          # fast compression of API responses, Pi CPU is slow
+gzip_json_min_size = 1024    # smaller responses are sent as they are
+static_max_age_s = 3600      # browsers can use css, fonts and icons without asking again
+staticFiles = StaticFileCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), "http"))
 # Websocket server
 PORT_NUMBER_WS = 8001
 websocket = None
+websocket_queue_size = 100     # messages waiting per client
+websocket_slow_policy = "drop" # full queue: "drop" the client (the page reconnects and resyncs) or "lag" it
+websocket_deflate = True       # permessage-deflate compression, if the browser supports it
+websocket_deflate_shared = False  # True: compress each message once for all clients (less CPU, but ~25% smaller instead of ~90%)
+websocket_deflate_min_size = 128  # smaller messages are sent as they are
+subscriptions = SubscriptionIndex()  # messages wanted by websocket clients
+websocket_resume_limit = 1000  # more missed messages: the page loads the list again
+websocket_resume_chunk = 100   # messages per replayed websocket message
+broadcastLock = threading.Lock()  # posting a message and resuming a client, so a message is sent to a client only once
+# Messages history, restored after restart
+messageLog = None
 
 # Posting to 3rd party server (not implemented, see MessageItem class)
 post_delay_s = 15.0
@@ -52,6 +93,10 @@ PRIORITY1 = 1
 PRIORITY2 = 2
 PRIORITY3 = 3
 PRIORITY4 = 4
+priorityClassifier = PriorityClassifier([(PRIORITY1, r"^A\s?1|\s?A\s?1|PRIO\s?1|^P\s?1"),
+                                         (PRIORITY2, r"^A\s?2|\s?A\s?2|PRIO\s?2|^P\s?2"),
+                                         (PRIORITY3, r"^B\s?1|^B\s?2|^B\s?3|PRIO\s?3|^P\s?3"),
+                                         (PRIORITY4, r"^PRIO\s?4|^P\s?4")], default=PRIORITY0)
 
 # Sender type
 SENDER_UNKNOWN = 0
@@ -63,61 +108,24 @@ SENDER_POCSAG = 64
 SENDER_POCSAG_ALPHA = 65
 SENDER_POCSAG_NUMERIC = 66
 SENDER_POCSAG_EMPTY = 67
+pocsagSenderTypes = {msgparser.POCSAG_EMPTY: SENDER_POCSAG_EMPTY,
+                     msgparser.POCSAG_ALPHA: SENDER_POCSAG_ALPHA,
+                     msgparser.POCSAG_NUMERIC: SENDER_POCSAG_NUMERIC}
 
 # Main view and data
 mainView = None
-messages = []
-capcodesDict = dict()
-capcodesIgnore = dict()
-filtersList = []
+messages = MessageStore(messagesLimit)
+messageIndex = MessageIndex()  # capcode and sender lists for the messages query
+textIndex = TextIndex()        # words of messages for the search
+capcodeIndex = CapcodeIndex()  # descriptions, ignored capcodes and classification
+capcodeFilter = CapcodeFilter()
 is_active = False
+pipelineStats = PipelineStats()
+recentFlexMessages = TimedIndex(merge_window_s)    # by the decoder time, so a replay merges like the live receiver
+recentPocsagMessages = TimedIndex(merge_window_s)  # POCSAG lines have no time, by the receive time
+ingestQueue = queue.Queue(maxsize=ingestQueueLimit)
+messagesEvent = threading.Event()
 
-# Capcodes classification
-capcodes_police = set()
-capcodes_fire = set()
-capcodes_ambu = set()
-
-
-class MessageItem(object):
-    __slots__ = ['message_raw', 'timestamp', 'timereceived', 'groupid', 'receivers', 'capcodes', 'body', 'priority', 'sender', 'is_posted']
-
-    def __init__(self):
-        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.message_raw = ""
-        self.timereceived = time.monotonic()
-        self.groupid = ""
-        self.receivers = ""
-        self.capcodes = []
-        self.body = ""
-        self.priority = 0
-        self.sender = 0
-        self.is_posted = False
-    
-    def toJSON(self):
-        data = {"timestamp": self.timestamp,
-                "timereceived": self.timereceived,
-                "groupid": self.groupid,
-                "receivers": self.receivers,
-                "capcodes": self.capcodes,
-                "body": self.body,
-                "priority": self.priority,
-                "sender": self.sender,
-                "message_raw": self.message_raw,
-                "is_posted": self.is_posted}
-        return json.dumps(data, default=lambda o: o.__dict__, sort_keys=True, indent=4)
-
-    def postToServer(self):
-        try:
-            print("POST:", self.toJSON())
-            # r = requests.post("http://mysuperserver.com", data=dict(payload=self.toJSON()))
-            # print("POST result:", r.status_code, r.reason)
-            # print("POST text:", r.text)
-            self.is_posted = True
-        except:
-            pass
-
-    def isPosted(self):
-        return self.is_posted
 
 # UI Main view
 
@@ -274,24 +282,28 @@ class UIConsoleView(object):
 # HTTP server
 
 class HTTPHandler(BaseHTTPRequestHandler):
+    # Socket timeout, a stalled client can not keep a worker forever
+    timeout = 30
   
-    def do_ReadFile(self, fileName):
-        abs_path = os.path.abspath(__file__)
-        dir_path = os.path.dirname(abs_path)
-        content = b""
-        try:
-            # All stuff stored in 'http' subfolder
-            file_path = dir_path + "/http" + fileName
-            # print("Read %s" % file_path)
-            with open(file_path, 'rb') as datafile:
-                content = datafile.read()
-            # print("Done, %sb" % len(content))
-        except Exception as e:
-            print("do_ReadFile Error: %s" % str(e))
-        return content
+    def do_ReadFile(self, fileName, use_gzip=False):
+        # All stuff stored in 'http' subfolder, returns responce code, type, content, encoding and headers
+        entry = staticFiles.get(fileName)
+        if entry is None:
+            print("do_ReadFile Error: %s not found" % fileName)
+            return 404, "text/html", b"Not found", None, []
+        encoding = "gzip" if use_gzip and entry.gzip is not None else None
+        etag = entry.etag[:-1] + '-gz"' if encoding is not None else entry.etag
+        # The page itself is always checked, so its new version is seen at once
+        cache_control = "no-cache" if entry.content_type == "text/html" else "max-age={}".format(static_max_age_s)
+        headers = [("ETag", etag), ("Last-Modified", email.utils.formatdate(entry.modified(), usegmt=True)),
+                   ("Cache-Control", cache_control)]
+        if self.isNotModified(etag, entry.modified()):
+            return 304, entry.content_type, b"", None, headers
+        return 200, entry.content_type, entry.gzip if encoding is not None else entry.content, encoding, headers
           
     def make_Reboot(self):
         print("Reboot after 5s")
+        saveMessagesNow()
         try:
             if utils.isRaspberryPi():
                 subprocess.Popen("(sleep 5 ; exec sudo reboot) &", stdout=subprocess.PIPE, shell=True)
@@ -300,46 +312,48 @@ class HTTPHandler(BaseHTTPRequestHandler):
 
     def make_Poweroff(self):
       print("Power off after 5s")
+      saveMessagesNow()
       try:
           if utils.isRaspberryPi():
               subprocess.Popen("(sleep 5 ; exec sudo halt) &", stdout=subprocess.PIPE, shell=True)
       except:
           pass
 
-    def do_getMessagesAsJson(self):
+    def do_getMessagesAsJson(self, query=None):
         global messages
-        js_list = map((lambda x: x.toJSON()), messages)
-        j = '[' + ", ".join(js_list) + ']'
-        return j.encode("utf-8")
-  
-    def file_isSupported(self, fileName):
-        types = [ '.css', '.htm', '.html', '.js', '.gif', '.jpeg', '.jpg', '.png', '.svg', '.text', '.txt', '.woff', '.ttf', '.eot', '.ico' ]
-        types_applied = [x for x in types if x in fileName.lower()]
-        return len(types_applied) > 0
-    
-    def ext_toResponceType(self, fileName):
-        content_types = {
-            '.css': 'text/css',
-            '.gif': 'image/gif',
-            '.ico': 'image/x-icon',
-            '.htm': 'text/html',
-            '.html': 'text/html',
-            '.jpeg': 'image/jpeg',
-            '.jpg': 'image/jpg',
-            '.svg': 'image/svg',
-            '.js': 'text/javascript',
-            '.png': 'image/png',
-            '.text': 'text/plain',
-            '.txt': 'text/plain',
-            '.ttf': 'font/ttf',
-            '.eot': 'application/vnd.ms-fontobject',
-            '.woff': 'application/font-woff'
-        }
-        for key, value in content_types.items():
-            if key in fileName.lower():
-                return value
-        
-        return "error: unknown type"
+        if query:
+            # Filtered request: /api/messages?capcode=...&sender=...&priority=...&since_id=...&from=...&to=...&limit=...
+            # Paging by message ids: ?before=<id>&limit=N for older messages, ?after=<id> for newer ones
+            params = urllib.parse.parse_qs(query)
+            since_id = queryParam(params, "after", int)
+            if since_id is None:
+                since_id = queryParam(params, "since_id", int)
+            capcode = queryParam(params, "capcode")
+            if capcode is not None and capcodeToInt(capcode) is None:
+                raise ValueError("Invalid 'capcode' parameter: {}".format(capcode))
+            time_from, time_to = queryParam(params, "from"), queryParam(params, "to")
+            for value in (time_from, time_to):
+                if value is not None:
+                    parseTime(value)
+            with messages.lock:
+                msg_list = messageIndex.query(messages, since_id=since_id, before_id=queryParam(params, "before", int),
+                                              time_from=time_from, time_to=time_to,
+                                              capcode=capcode, priority=queryParam(params, "priority", int),
+                                              sender=queryParam(params, "sender", int), limit=queryParam(params, "limit", int))
+                return joinMessagesJson(msg_list)
+        with messages.lock:
+            return joinMessagesJson(messages.newest())
+
+    def do_searchMessagesAsJson(self, query):
+        # Text search: /api/search?q=amsterdam 1098*&limit=100
+        params = urllib.parse.parse_qs(query)
+        q = queryParam(params, "q") or ""
+        limit = queryParam(params, "limit", int)
+        if limit is None:
+            limit = 100
+        with messages.lock:
+            msg_list = textIndex.search(messages, q, limit)
+            return joinMessagesJson(msg_list)
             
     def do_HEAD(self):
         # print("HEAD:", self.path)
@@ -350,17 +364,34 @@ class HTTPHandler(BaseHTTPRequestHandler):
             self.send_header("Content-type", "application/json")
         self.end_headers()
 
+    def isNotModified(self, etag, modified=None):
+        # Conditional request: the client already has this version (modified: None if only ETag is used)
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            return etag in tags or "*" in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None and modified is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+                return int(modified) <= since
+            except (TypeError, ValueError):
+                pass
+        return False
+
     def do_GET(self):
         responce = b"error"
         responceCode = 400
         responceType = "application/json"
+        responceHeaders = []
+        responceEncoding = None
         try:
             # print("GET:", self.path)
+            url = urllib.parse.urlsplit(self.path)
+            use_gzip = acceptsGzip(self.headers.get("Accept-Encoding"))
             # Main page: show html
-            if self.path == "/":
-                responceCode = 200
-                responceType = "text/html"
-                responce = self.do_ReadFile("/index.html")
+            if url.path == "/":
+                responceCode, responceType, responce, responceEncoding, responceHeaders = self.do_ReadFile("/index.html", use_gzip)
             # RPi commands: reboot
             elif self.path == "/api/reboot":
                 self.make_Reboot()
@@ -373,22 +404,57 @@ class HTTPHandler(BaseHTTPRequestHandler):
                 responceCode = 200
                 responceType = "text/html"
                 responce = b"Power off after 5s"
-            # API: get received messages
-            elif self.path == "/api/messages":
+            # API: receiver pipeline counters
+            elif self.path == "/api/stats":
                 responceCode = 200
                 responceType = "application/json"
-                responce = self.do_getMessagesAsJson()
+                responce = json.dumps(pipelineStats.asDict()).encode("utf-8")
+            # API: search in messages text, get received messages
+            elif url.path == "/api/search" or url.path == "/api/messages":
+                # The version is taken before the list, so the list can only be newer than the tag
+                # Gzipped and plain responses are different representations, with different tags.
+                # No Last-Modified: its 1s resolution would hide changes made in the same second
+                with messages.lock:
+                    etag = '"{}{}"'.format(messages.versionTag(), "-gz" if use_gzip else "")
+                responceType = "application/json"
+                responceHeaders = [("ETag", etag), ("Cache-Control", "no-cache")]
+                try:
+                    if self.isNotModified(etag):
+                        responceCode = 304
+                        responce = b""
+                    elif url.path == "/api/search":
+                        responce = self.do_searchMessagesAsJson(url.query)
+                        responceCode = 200
+                    else:
+                        responce = self.do_getMessagesAsJson(url.query)
+                        responceCode = 200
+                except ValueError as e:
+                    # Invalid query parameters
+                    responceCode = 400
+                    responce = json.dumps({"error": str(e)}).encode("utf-8")
+                    responceHeaders = []
             # Check if file is supported
-            elif self.file_isSupported(self.path):
-                responceCode = 200
-                responceType = self.ext_toResponceType(self.path)
-                responce = self.do_ReadFile(self.path)
+            elif contentType(url.path) is not None:
+                responceCode, responceType, responce, responceEncoding, responceHeaders = self.do_ReadFile(url.path, use_gzip)
+
+            # Compress big API responses
+            if use_gzip and responceCode == 200 and responceEncoding is None and \
+               responceType == "application/json" and len(responce) >= gzip_json_min_size:
+                responce = gzipBytes(responce, gzip_json_level)
+                responceEncoding = "gzip"
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             print("Error: ", exc_tb.tb_lineno, str(e))
 
         self.send_response(responceCode)
-        self.send_header("Content-type", responceType)
+        if responceCode != 304:
+            self.send_header("Content-type", responceType)
+            self.send_header("Content-Length", str(len(responce)))
+        if responceEncoding is not None:
+            self.send_header("Content-Encoding", responceEncoding)
+        self.send_header("Vary", "Accept-Encoding")
+        for name, value in responceHeaders:
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(responce)
 
@@ -419,44 +485,47 @@ def checkRTLSDR():
 
     return res
 
-def loadCapcodesDict(filename):
+def loadCapcodesDict(filename, index, ignore=False):
     # Load capcodes dictionary: "capcode,description" pairs
-    capcodes = dict()
+    count = 0
     try:
         print("Loading {}".format(filename))
         with open(filename, "r") as text_file:
-            lines = text_file.readlines()
-            for s in lines:
+            for s in text_file:
                 if s[0] == '#':
                     continue
 
                 fields = s.split(',')
                 if len(fields) == 2:
-                    capcodes[fields[0].strip()] = fields[1].strip()
+                    if ignore:
+                        index.addIgnore(fields[0].strip())
+                    else:
+                        index.addDescription(fields[0].strip(), fields[1].strip())
+                    count += 1
     except:
         pass
-    return capcodes
+    return count
 
-def loadCapcodesSet(filename):
+def loadCapcodesSet(filename, index, discipline):
     # Load capcodes list from a raw text file: 00001, 00002, ...
-    capcodes = set()
+    count = 0
     try:
         print("Loading capcodes for classifier {}".format(filename))
         with open(filename, "r") as text_file:
-            lines = text_file.readlines()
-            for s in lines:
+            for s in text_file:
                 if s[0] == '#':
                     continue
                 
-                fields = s.strip().split(', ')
-                capcodes.update(fields)
+                for capcode in s.strip().split(', '):
+                    index.addDiscipline(capcode, discipline)
+                    count += 1
     except:
           pass
-    print("  {} loaded".format(len(capcodes)))
-    return capcodes
+    print("  {} loaded".format(count))
+    return count
 
 def loadFilter(filterFile):
-    global filtersList
+    global capcodeFilter
     filtersList = []
     try:
         with open(filterFile, "r") as text_file:
@@ -465,28 +534,96 @@ def loadFilter(filterFile):
             filtersList = list(filter(lambda s: len(s) > 0 and s[0:1] != "#" and s[0:1] != ";", lines_strip))
     except:
         pass
+    # All patterns are compiled into one matcher
+    capcodeFilter.compile(filtersList)
 
 def checkFilter(capcode):
-    global filtersList
+    global capcodeFilter
     # If filter not loaded, disable
-    if len(filtersList) == 0:
-        return True
-
-    # Check if capcode applied to at least one filter
-    for f_str in filtersList:
-        if fnmatch.fnmatch(capcode, f_str):
-            return True
-    return False
-
-def getSender(capcode, message):
-    global capcodes_police, capcodes_fire, capcodes_ambu
+    return capcodeFilter.matches(capcode)
+
+def parseDevices(devicesArg, defaultFrequency):
+    # "0,1:172.45M" => [("0", "169.65M"), ("1", "172.45M")]
+    devices = []
+    for s in str(devicesArg).split(','):
+        fields = s.strip().split(':')
+        if len(fields[0]) == 0:
+            continue
+        devices.append((fields[0], fields[1] if len(fields) > 1 and len(fields[1]) > 0 else defaultFrequency))
+    return devices if len(devices) > 0 else [("0", defaultFrequency)]
+
+def storeMessage(msg):
+    # Add new message to the store and indexes, the oldest one is evicted if the store is full
+    with messages.lock:
+        evicted = messages.append(msg)
+        if evicted is not None:
+            messageIndex.remove(evicted)
+            textIndex.remove(evicted)
+        messageIndex.add(msg)
+        textIndex.add(msg)
+
+def queryParam(params, name, conv=str):
+    # Query parameter value or None, ValueError if it can not be converted
+    if name not in params:
+        return None
+    try:
+        return conv(params[name][0])
+    except ValueError:
+        raise ValueError("Invalid '{}' parameter: {}".format(name, params[name][0]))
+
+def logMergedMessage(msg):
+    # Receivers merged after posting: the message is saved again, the newest record of an id is restored
+    if messageLog is not None and msg.isPosted():
+        messageLog.append(msg.toDict())
+
+def saveMessagesNow():
+    # Before reboot or exit: messages are saved only when posted, the not yet posted ones are saved now too.
+    # If they are posted later, the newer record of the id is restored
+    if messageLog is None:
+        return
+    not_posted = []
+    with messages.lock:
+        for p in range(len(messages) - 1, -1, -1):
+            msg = messages.at(p)
+            if msg.isPosted():
+                break
+            not_posted.append(msg.toDict())
+    for data in reversed(not_posted):
+        messageLog.append(data)
+    messageLog.flush()
+
+def recentMessage(index, key, now):
+    # Message with the same text in the merge window, None if there is none or it was evicted from the store
+    existing = index.get(key, now)
+    if existing is not None and messages.getById(existing.id) is not existing:
+        return None
+    return existing
+
+def joinMessagesJson(msg_list):
+    # JSON array from the cached messages JSON, should be called with the messages lock held
+    return b'[' + b','.join([msg.toJSONBytes() for msg in msg_list]) + b']'
+
+def resumeWebsocketClient(server, client, last_id):
+    # Send posted messages newer than last_id to a reconnected client, as JSON arrays, oldest first.
+    # Live messages are not sent meanwhile, they come after the replay
+    with broadcastLock:
+        with messages.lock:
+            # Not posted messages are not counted: the client gets them live
+            missed = [msg for msg in reversed(messageIndex.query(messages, since_id=last_id)) if msg.isPosted()]
+            # Incomplete if messages were evicted from the store, or the app was restarted without history
+            oldest_id = messages.at(0).id if len(messages) > 0 else messages.last_id + 1
+            complete = oldest_id <= last_id + 1 and last_id <= messages.last_id and len(missed) <= websocket_resume_limit
+            missed = [msg for msg in missed if subscriptions.isRecipient(client['id'], msg)] if complete else []
+            chunks = [joinMessagesJson(missed[p:p + websocket_resume_chunk]) for p in range(0, len(missed), websocket_resume_chunk)]
+        for chunk in chunks:
+            server.send_message(client, chunk)
+        server.send_message(client, json.dumps({"resumed": {"last_id": last_id, "count": len(missed), "complete": complete}}))
+    print("Websocket: client-%d resumed from id %d, %d messages sent" % (client['id'], last_id, len(missed)))
+
+def getSender(capcodeInfo, message):
     # Check from capcodes list
-    if capcode in capcodes_police:
-        return SENDER_POLICE
-    if capcode in capcodes_fire:
-        return SENDER_BRAND
-    if capcode in capcodes_ambu:
-        return SENDER_AMBU
+    if capcodeInfo is not None and capcodeInfo.discipline != SENDER_UNKNOWN:
+        return capcodeInfo.discipline
 
     # Try to analyse the text
 
@@ -496,7 +633,7 @@ def getSender(capcode, message):
 if __name__ == "__main__":
     print("")
     print("P2000 decoder v0.4 by Dmitrii Eliseev\n")
-    print("Run:\npython3 p2000.py --lcd=true|false [--filter=filter.txt] [--capcodes=capcodes.txt] [--ignore=capcodes_ignore.txt] [--device=0]")
+    print("Run:\npython3 p2000.py --lcd=true|false [--filter=filter.txt] [--capcodes=capcodes.txt] [--ignore=capcodes_ignore.txt] [--device=0[:freq],1[:freq]] [--limit=5000] [--history=history|none] [--replay=capture.log --speed=realtime|Nx|max [--exit]] [--raw]")
     print("")
     print("Server running: http://{}:{}".format(utils.getIPAddress(), PORT_NUMBER))
     print("API (GET): http://{}:{}/api/messages".format(utils.getIPAddress(), PORT_NUMBER))
@@ -509,6 +646,12 @@ if __name__ == "__main__":
     parser.add_argument("--capcodes", dest="capcodes", default=None)
     parser.add_argument("--ignore", dest="ignore", default=None)
     parser.add_argument("--device", dest="device", default=0)
+    parser.add_argument("--limit", dest="limit", type=int, default=messagesLimit)
+    parser.add_argument("--history", dest="history", default=None)
+    parser.add_argument("--replay", dest="replay", default=None)
+    parser.add_argument("--speed", dest="speed", default="max")
+    parser.add_argument("--exit", dest="exit", action="store_true", help="Exit when the replay is finished")
+    parser.add_argument("--raw", dest="raw", action="store_true", help="Keep raw multimon-ng lines of messages")
     args = parser.parse_args()
 
     # Set current folder
@@ -522,214 +665,323 @@ if __name__ == "__main__":
     print("LCD in use:", "no" if no_lcd else "yes")
     print("Frequency:", frequency)
 
-    # Device ID
-    device = args.device
+    # Messages memory
+    messagesLimit = args.limit
+    messages = MessageStore(messagesLimit)
+    print("Messages limit:", messagesLimit)
+    keep_raw_lines = args.raw
+
+    # Messages history folder, "none" to disable
+    history_path = args.history
+    if history_path is None:
+        history_path = dir_path + os.sep + "history"
+    if history_path.lower() != "none":
+        messageLog = MessageLog(history_path, messagesLimit)
+        print("History:", history_path)
+
+    # Device IDs, "0" or "0,1" or "0:169.65M,1:172.45M"
+    devices = parseDevices(args.device, frequency)
+    print("Devices:", ", ".join("{} ({})".format(d, f) for d, f in devices))
+
+    # Replay mode
+    if args.replay is not None:
+        replay_file = args.replay
+        try:
+            replay_speed = replay.parseSpeed(args.speed)
+        except ValueError as e:
+            parser.error(str(e))
+        replay_exit = args.exit
+        devices = [("replay", frequency)]
+        print("Replay: {}, speed: {}".format(replay_file, args.speed))
 
     # Check RTLSDR connection
     rtl_found = checkRTLSDR()
     print("")
 
-    # Load capcodes file
+    # Capcodes files
     capcodes_path = args.capcodes
     if capcodes_path is None:
         capcodes_path = dir_path + os.sep + "capcodes.txt"
-    capcodesDict = loadCapcodesDict(capcodes_path)
-    print("Capcodes: {} records loaded".format(len(capcodesDict)))
-
-    # Load capcodes ignore file
     ignore_path = args.ignore
     if ignore_path is None:
         ignore_path = dir_path + os.sep + "capcodes_ignore.txt"
-    capcodesIgnore = loadCapcodesDict(ignore_path)
-    print("Capcodes ignore: {} records loaded".format(len(capcodesIgnore)))
+    classifier_paths = [(dir_path + os.sep + "cc_police.txt", SENDER_POLICE),
+                        (dir_path + os.sep + "cc_fire.txt", SENDER_BRAND),
+                        (dir_path + os.sep + "cc_ambu.txt", SENDER_AMBU)]
+    capcodes_sources = [capcodes_path, ignore_path] + [path for path, sender in classifier_paths]
+    snapshot_path = os.path.splitext(capcodes_path)[0] + ".idx"
+
+    # Load capcodes index from the binary snapshot, if the text files were not changed
+    snapshot = CapcodeIndex.loadSnapshot(snapshot_path, capcodes_sources)
+    if snapshot is not None:
+        capcodeIndex = snapshot
+        print("Capcodes index: {} records loaded from {}".format(len(capcodeIndex), snapshot_path))
+    else:
+        # Load capcodes file
+        count = loadCapcodesDict(capcodes_path, capcodeIndex)
+        print("Capcodes: {} records loaded".format(count))
+
+        # Load capcodes ignore file
+        count = loadCapcodesDict(ignore_path, capcodeIndex, ignore=True)
+        print("Capcodes ignore: {} records loaded".format(count))
+
+        # Load capcodes classifier
+        for path, sender in classifier_paths:
+            loadCapcodesSet(path, capcodeIndex, sender)
+        capcodeIndex.freeze()
+        print("Capcodes index: {} records".format(len(capcodeIndex)))
+        if capcodeIndex.saveSnapshot(snapshot_path, capcodes_sources):
+            print("Capcodes index saved to {}".format(snapshot_path))
+
+    MessageItem.capcodeIndex = capcodeIndex
 
     # Load filter file
     filter_path = args.filter
     if filter_path is not None and len(filter_path) > 0:
         loadFilter(filter_path)
-    print("Filter: {} strings loaded".format(len(filtersList)))
+    print("Filter: {} strings loaded".format(len(capcodeFilter)))
     print("")
 
-    # Load capcodes classifier
-    capcodes_police = loadCapcodesSet(dir_path + os.sep + "cc_police.txt")
-    capcodes_fire = loadCapcodesSet(dir_path + os.sep + "cc_fire.txt")
-    capcodes_ambu = loadCapcodesSet(dir_path + os.sep + "cc_ambu.txt")
-
     # Debug=True - without receiver, for simulation: gcc debugtest.c -odebugtest)
     # if utils.isRaspberryPi() is False:
     debug = False
 
-    if rtl_found is False and debug is False:
+    if rtl_found is False and debug is False and replay_file is None:
         print("App finished, configuration is not complete")
         sys.exit(0)
 
-    # Data receiving thread
-    def dataThreadFunc():
-        global is_active, mainView, device, frequency, messages, capcodesDict, capcodesIgnore, debug
+    # Data receiving thread: only drains the process output into the ingest queue
+    def dataThreadFunc(device, frequency):
+        global is_active, debug, replay_file, replay_speed
 
         cmd = "rtl_fm -d {} -f {} -M fm -s 22050 -g {} -p {} | multimon-ng -a FLEX -a POCSAG512 -a POCSAG1200 -a POCSAG2400 -t raw -".format(device, frequency, gain, correction)
         abs_path = os.path.abspath(__file__)
         dir_path = os.path.dirname(abs_path)
         if os.name == 'nt':
             cmd = cmd.replace("multimon-ng", "win32\\multimon-ng.exe")
-        print("Run process:\n", cmd)
         if debug:
             cmd = dir_path + "/./debugtest"
             print("Debug process", cmd)
         
-        multimon_ng = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        try:
-            while is_active:
-                # Read line from process
-                line = multimon_ng.stdout.readline()
+        if replay_file is not None:
+            print("Replay process:", replay_file)
+            source = replay.ReplaySource(replay_file, replay_speed)
+            # Throughput is counted from here, without the app start
+            pipelineStats.reset()
+            try:
+                item = 0
+                while is_active and item is not None:
+                    # Replay: file data can't be lost, wait for the processing thread
+                    line = source.readline()
+                    item = (device, line, time.perf_counter()) if len(line) > 0 else None
+                    while is_active:
+                        try:
+                            ingestQueue.put(item, timeout=1.0)
+                            break
+                        except queue.Full:
+                            pass
+            except KeyboardInterrupt:
+                pass
+            source.close()
+            print("Data thread stopped")
+            return
+
+        # Supervise the receiver pipeline: restart it if the process has finished
+        while is_active:
+            print("Run process (device {}):\n".format(device), cmd)
+            multimon_ng = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+            try:
+                while is_active:
+                    # Read line from process
+                    line = multimon_ng.stdout.readline()
+                    if len(line) == 0 and multimon_ng.poll() is not None:
+                        print("Device {}: process finished, code {}".format(device, multimon_ng.returncode))
+                        break
+                    try:
+                        ingestQueue.put_nowait((device, line, time.perf_counter()))
+                    except queue.Full:
+                        pipelineStats.addDropped()
+            except KeyboardInterrupt:
+                is_active = False
+            except BaseException as e:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                print("dataThreadFunc::Error in line: ", exc_type, fname, exc_tb.tb_lineno, str(e))
+            if multimon_ng.poll() is None:
+                os.kill(multimon_ng.pid, 9)
+            if is_active:
+                time.sleep(5.0)
+        print("Data thread stopped (device {})".format(device))
+
+    # Add one parsed line to the messages list
+    def processParsedLine(parsed):
+        key = (parsed.protocol, parsed.body)
+        if parsed.protocol == msgparser.PROTOCOL_FLEX:
+            now = parseTimestamp(parsed.timestamp)
+            message = parsed.body
+            pr = priorityClassifier.classify(message)
+            # Can be several capcodes in one message
+            for capcode in parsed.capcodes:
+                # Apply filter
+                if checkFilter(capcode) is False:
+                    continue
+                capcode_info = capcodeIndex.lookup(capcode)
+                if capcode_info is not None and capcode_info.ignore:
+                    print("Message {} to {} ignored".format(message, capcode))
+                    continue
+
+                # Receivers text is made from capcodes when needed, with names from the capcodes index
+                capcode_number = capcodeToInt(capcode)
+                if capcode_number is None:
+                    continue
+
+                # If the message was already received, only add receivers capcode
+                existing = recentMessage(recentFlexMessages, key, now)
+                if existing is not None:
+                    with messages.lock:
+                        merged = existing.addCapcode(capcode_number)
+                        if merged:
+                            messageIndex.addCapcode(existing, capcode_number)
+                        if existing.sender == SENDER_UNKNOWN:
+                            existing.sender = getSender(capcode_info, message)
+                            messageIndex.changeSender(existing, SENDER_UNKNOWN)
+                        existing.invalidate()
+                        messages.touch()
+                    if merged:
+                        logMergedMessage(existing)
+                else:
+                    msg = MessageItem(msgparser.PROTOCOL_FLEX)
+                    msg.groupid = sys.intern(parsed.groupid)
+                    msg.addCapcode(capcode_number)
+                    msg.body = message
+                    msg.message_raw = parsed.raw if keep_raw_lines else None
+                    msg.sender = getSender(capcode_info, message)
+                    msg.priority = pr
+                    msg.timestamp = parsed.timestamp
+                    msg.is_posted = False
+                    storeMessage(msg)
+                    recentFlexMessages.put(key, msg, now)
+
+        if parsed.protocol == msgparser.PROTOCOL_POCSAG:
+            receiver, message, pr = capcodeToInt(parsed.capcodes[0]), parsed.body, PRIORITY2
+            type = pocsagSenderTypes[parsed.format]
+            if receiver is None:
+                return
+
+            # If the message was already received, only add receivers number
+            now = time.monotonic()
+            existing = recentMessage(recentPocsagMessages, key, now)
+            if existing is not None:
+                with messages.lock:
+                    merged = existing.addCapcode(receiver)
+                    if merged:
+                        messageIndex.addCapcode(existing, receiver)
+                        existing.invalidate()
+                        messages.touch()
+                if merged:
+                    logMergedMessage(existing)
+            else:
+                msg = MessageItem(msgparser.PROTOCOL_POCSAG)
+                msg.groupid = 0
+                msg.addCapcode(receiver)
+                msg.body = message
+                msg.message_raw = parsed.raw if keep_raw_lines else None
+                msg.sender = type
+                msg.priority = pr
+                msg.is_posted = False
+                storeMessage(msg)
+                recentPocsagMessages.put(key, msg, now)
+
+    # Data processing thread: parses queued lines in batches, one UI update per batch
+    def processThreadFunc():
+        global is_active, mainView
+
+        print("Data processing thread started")
+
+        # Restore saved messages, receiving threads are already filling the queue meanwhile
+        if messageLog is not None:
+            time_start = time.perf_counter()
+            records = messageLog.load(messagesLimit)
+            # Messages merged after posting were saved again: only the newest record of an id, in id order
+            latest = dict()
+            for data in records:
+                if data.get("id") is not None:
+                    latest[data["id"]] = data
+            records = [data for data in records if data.get("id") is None or latest[data["id"]] is data]
+            records.sort(key=lambda data: data.get("id") or 0)
+            for data in records:
+                msg = MessageItem.fromDict(data)
+                msg.is_posted = True
+                storeMessage(msg)
+            print("History: {} messages restored in {:.2f}s".format(len(records), time.perf_counter() - time_start))
+            mainView.updateUI()
+            messageLog.start()
+
+        finished = False
+        duplicates = TimedIndex(duplicate_window_s)
+        while is_active and not finished:
+            try:
+                batch = [ingestQueue.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            while len(batch) < ingestBatchLimit:
                 try:
-                    line = line.decode('utf8', 'backslashreplace')
-                except:
-                    line = ""
-                    print("Warning: cannot decode utf8 string")
-                multimon_ng.poll()
-                if line.startswith('FLEX'):
-                    if line.__contains__("ALN") or line.__contains__("NUM"):
-                        # Parsing based on
-                        # https://nl.oneguyoneblog.com/2016/08/09/p2000-ontvangen-decoderen-raspberry-pi/
-                        # Message sample:
-                        if "FLEX|" not in line:
-                            # Old multimon-ng version
-                            # FLEX: 2018-07-29 11:43:27 1600/2/K/A 10.120 [001523172] ALN A1 Boerhaavelaan HAARLM : 16172
-                            # FLEX: 2020-10-17 18:40:19 1600/2/A 10.020 [001530615] NUM 3301
-                            line_data = line.split(' ') if "FLEX|" not in line else line.split('|')
-                            flex = line[0:5]
-                            timestamp = line_data[1] + " " + line_data[2]
-                            message = line[line.find("ALN")+4:].strip() if "ALN" in line else line[line.find("NUM")+4:].strip()
-                            groupid = line_data[4].strip()
-                            capcodes = line_data[5].replace('[', '').replace(']', '') # line[43:52].strip()
-                        else:
-                            # New multimon-ng version
-                            # FLEX|2020-10-17 08:18:37|1600/2/K/A|04.093|002029568 000120999 000120342|ALN|A2 13342 Rit 92107 Amsterdam Carolina MacGillavrylaan 1098XB
-                            line_data = line.split('|')
-                            timestamp = line_data[1]
-                            groupid = line_data[3].strip()
-                            capcodes = line_data[4].strip()
-                            message = line_data[6].strip()
-
-                        print(line.strip())
-
-                        # Can be several capcodes in one message
-                        for capcode in capcodes.split(' '):
-                            # Apply filter
-                            if checkFilter(capcode) is False:
-                                continue
-                            if capcode in capcodesIgnore:
-                                print("Message {} to {} ignored".format(message, capcode))
-                                continue
-
-                            regex_prio1 = "^A\s?1|\s?A\s?1|PRIO\s?1|^P\s?1"
-                            regex_prio2 = "^A\s?2|\s?A\s?2|PRIO\s?2|^P\s?2"
-                            regex_prio3 = "^B\s?1|^B\s?2|^B\s?3|PRIO\s?3|^P\s?3"
-                            regex_prio4 = "^PRIO\s?4|^P\s?4"
-                            msg_words = message.split(' ')
-                            msg_start = ""
-                            if len(msg_words) > 0:
-                                msg_start += msg_words[0]
-                            if len(msg_words) > 1:
-                                msg_start += ' ' + msg_words[1]
-                            pr = PRIORITY0
-                            if re.search(regex_prio1, msg_start, re.IGNORECASE):
-                                pr = PRIORITY1
-                            elif re.search(regex_prio2, msg_start, re.IGNORECASE):
-                                pr = PRIORITY2
-                            elif re.search(regex_prio3, msg_start, re.IGNORECASE):
-                                pr = PRIORITY3
-                            elif re.search(regex_prio4, msg_start, re.IGNORECASE):
-                                pr = PRIORITY4
-
-                            # Get name from capcode, if exist
-                            receiver_name = "{} ({})".format(capcodesDict[capcode], capcode) if capcode in capcodesDict else capcode
-
-                            # If the message was already received, only add receivers capcode
-                            if len(messages) > 0 and messages[0].body == message:
-                                messages[0].receivers += (", " + receiver_name)
-                                messages[0].capcodes.append(capcode)
-                                if messages[0].sender == SENDER_UNKNOWN:
-                                    messages[0].sender = getSender(capcode, message)
-                            else:
-                                msg = MessageItem()
-                                msg.groupid = groupid
-                                msg.receivers = receiver_name
-                                msg.capcodes = [capcode]
-                                msg.body = message
-                                msg.message_raw = line.strip()
-                                msg.sender = getSender(capcode, message)
-                                msg.priority = pr
-                                msg.timestamp = timestamp
-                                msg.is_posted = False
-                                messages.insert(0, msg)
-            
-                        # Limit the list size
-                        if len(messages) > messagesLimit:
-                            messages = messages[:messagesLimit]
-                        
-                        # Update UI
-                        mainView.updateUI()
-                if line.startswith('POCSAG'):
-                    # Message sample:
-                    # POCSAG1200: Address:  104206  Function: 3  Alpha:   CompaxoHybridO|[Onderwerp:]Min. afw. ruimtetemp.-H: Vriescel 2042|[Inhoud:]<EOT><EOT>
-                    # POCSAG1200: Address:    1000  Function: 3
-                    # POCSAG1200: Address:  175557  Function: 0  Numeric: 0715828347
-
-                    print(line.strip())
-                    
-                    receiver, message, type, pr = None, "-", SENDER_POCSAG, PRIORITY2
-                    
-                    addr_index = line.find("Address:")
-                    func_index = line.find("Function:")
-                    alpha_index = line.find("Alpha:")
-                    numeric_index = line.find("Numeric:")
-                    if addr_index != -1 and func_index != -1:
-                        receiver = line[addr_index + 9:func_index].strip()
-                    if alpha_index != -1:
-                        type = SENDER_POCSAG_ALPHA
-                        message = line[alpha_index+6:].strip()
-                    if numeric_index != -1:
-                        type = SENDER_POCSAG_NUMERIC
-                        message = line[numeric_index+9:].strip()
-                    if message == "-":
-                        type = SENDER_POCSAG_EMPTY
-
-                    if receiver is None:
-                        continue
+                    batch.append(ingestQueue.get_nowait())
+                except queue.Empty:
+                    break
 
-                    # If the message was already received, only add receivers number
-                    if len(messages) > 0 and messages[0].body == message:
-                        messages[0].receivers += (", " + receiver)
-                        messages[0].capcodes.append(receiver)
-                    else:
-                        msg = MessageItem()
-                        msg.groupid = 0
-                        msg.receivers = receiver
-                        msg.capcodes = [receiver]
-                        msg.body = message
-                        msg.message_raw = line.strip()
-                        msg.sender = type
-                        msg.priority = pr
-                        msg.is_posted = False
-                        messages.insert(0, msg)
-                        
-                    # Limit the list size
-                    if len(messages) > messagesLimit:
-                        messages = messages[:messagesLimit]
-                        
-                    # Update UI
+            try:
+                times_read = []
+                for item in batch:
+                    if item is None:
+                        finished = True
+                        break
+                    device, line, time_read = item
+                    pipelineStats.addLine(device)
+                    try:
+                        line = line.decode('utf8', 'backslashreplace')
+                    except:
+                        line = ""
+                        print("Warning: cannot decode utf8 string")
+                    parsed = msgparser.parseLine(line)
+                    if parsed is None:
+                        continue
+                    pipelineStats.addDecoded(device)
+
+                    # The same message from other receivers is ignored
+                    if len(devices) > 1:
+                        now = time.monotonic()
+                        key = (parsed.protocol, tuple(parsed.capcodes), parsed.body)
+                        received_by = duplicates.get(key, now)
+                        if received_by is not None and received_by != device:
+                            pipelineStats.addDuplicate(device)
+                            continue
+                        duplicates.put(key, device, now)
+
+                    print(parsed.raw)
+                    processParsedLine(parsed)
+                    times_read.append(time_read)
+
+                if len(times_read) > 0:
+                    # Update UI and notify the post thread
                     mainView.updateUI()
+                    messagesEvent.set()
+                    time_done = time.perf_counter()
+                    for time_read in times_read:
+                        pipelineStats.addMessage(time_done - time_read)
+                pipelineStats.addBatch(len(batch))
+            except BaseException as e:
+                exc_type, exc_obj, exc_tb = sys.exc_info()
+                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                print("processThreadFunc::Error in line: ", exc_type, fname, exc_tb.tb_lineno, str(e))
 
-        except KeyboardInterrupt:
-            os.kill(multimon_ng.pid, 9)
-        except BaseException as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            print("dataThreadFunc::Error in line: ", exc_type, fname, exc_tb.tb_lineno, str(e))
-            os.kill(multimon_ng.pid, 9)
-        print("Data thread stopped")
+        if finished:
+            print("Replay finished")
+            pipelineStats.report()
+            if replay_exit:
+                # Stops the UI main loop, like Ctrl+C
+                _thread.interrupt_main()
+        print("Data processing thread stopped")
 
 
     # HTTP server handling thread
@@ -748,13 +1000,45 @@ if __name__ == "__main__":
         global websocket
 
         def on_connected(client, server):
+            subscriptions.addClient(client['id'])
             print("Websocket: client-%d connected" % client['id'])
 
         def on_disconnected(client, server):
+            subscriptions.removeClient(client['id'])
             print("Websocket: client-%d disconnected" % client['id'])
 
         def on_message_received(client, server, message):
-            print("Websocket: client-%d sent message: %s" % (client['id'], message))
+            # Commands: {"subscribe": {"capcodes": [...], "priority": N, "senders": [...], "keywords": [...]}}, {"unsubscribe": true},
+            # {"resume": last_id}
+            try:
+                command = json.loads(message)
+            except ValueError:
+                command = None
+            if not isinstance(command, dict):
+                print("Websocket: client-%d sent message: %s" % (client['id'], message))
+                return
+
+            if "subscribe" in command:
+                try:
+                    subscription = parseSubscription(client['id'], command["subscribe"])
+                except ValueError as e:
+                    server.send_message(client, json.dumps({"error": str(e)}))
+                    return
+                subscriptions.subscribe(subscription)
+                print("Websocket: client-%d subscribed to %s" % (client['id'], json.dumps(subscription.toDict())))
+                server.send_message(client, json.dumps({"subscribed": subscription.toDict()}))
+            elif "unsubscribe" in command:
+                subscriptions.unsubscribe(client['id'])
+                print("Websocket: client-%d unsubscribed" % client['id'])
+                server.send_message(client, json.dumps({"subscribed": None}))
+            elif "resume" in command:
+                last_id = command["resume"]
+                if not isinstance(last_id, int) or isinstance(last_id, bool) or last_id < 0:
+                    server.send_message(client, json.dumps({"error": "'resume' should be the last received message id"}))
+                    return
+                resumeWebsocketClient(server, client, last_id)
+            else:
+                server.send_message(client, json.dumps({"error": "Unknown command"}))
 
         print("Websocket thread started")
         websocket.set_fn_new_client(on_connected)
@@ -772,42 +1056,84 @@ if __name__ == "__main__":
                 break
 
             try:
+                # Messages are posted in order, so everything older than a posted one is done.
+                # One snapshot under the lock: positions shift when new messages are appended
                 now = time.monotonic()
-                for msg in messages:
-                    if msg.isPosted() is False and now - msg.timereceived >= post_delay_s:
+                ready = []
+                with messages.lock:
+                    for p in range(len(messages) - 1, -1, -1):
+                        msg = messages.at(p)
+                        if msg.isPosted():
+                            break
+                        if now - msg.timereceived >= post_delay_s:
+                            ready.append(msg)
+                # Oldest first: websocket clients get the ids in ascending order, which "resume" relies on
+                for msg in reversed(ready):
+                    with broadcastLock:
+                        if msg.isPosted():
+                            continue
                         msg.postToServer()
-                        websocket.send_message_to_all(msg.toJSON())
+                        with messages.lock:
+                            msg.invalidate()
+                            messages.touch()
+                            msg_json = msg.toJSON()
+                        # Only to the clients which subscribed to this message, and to clients without a subscription
+                        recipients = subscriptions.recipients(msg)
+                        if recipients is None:
+                            websocket.send_message_to_all(msg_json)
+                        else:
+                            websocket.send_message_to_clients(recipients, msg_json)
+                    # Message is complete now (all receivers merged), save it
+                    if messageLog is not None:
+                        messageLog.append(msg.toDict())
             except BaseException as e:
                 exc_type, exc_obj, exc_tb = sys.exc_info()
                 print("postThreadFunc error in line: ", exc_type, exc_tb.tb_lineno, str(e))
 
-            time.sleep(1.0)
+            messagesEvent.wait(1.0)
+            messagesEvent.clear()
         print("Data post thread stopped")
 
     is_active = True
 
     mainView = UIMainView() if no_lcd is False else UIConsoleView()
 
-    dataThread = threading.Thread(target=dataThreadFunc)
-    dataThread.start()
+    pipelineStats.setGauge("queue_depth", ingestQueue.qsize)
+    processThread = threading.Thread(target=processThreadFunc)
+    processThread.start()
+
+    for device_id, device_frequency in devices:
+        dataThread = threading.Thread(target=dataThreadFunc, args=(device_id, device_frequency))
+        dataThread.start()
 
-    websocket = WebsocketServer(PORT_NUMBER_WS, host="0.0.0.0")
+    websocket = WebsocketServer(PORT_NUMBER_WS, host="0.0.0.0", send_queue_size=websocket_queue_size,
+                                slow_client_policy=websocket_slow_policy, deflate=websocket_deflate,
+                                deflate_shared=websocket_deflate_shared, deflate_min_size=websocket_deflate_min_size)
+    pipelineStats.setGauge("websocket", websocket.clients_stats)
+    pipelineStats.setGauge("subscriptions", subscriptions.stats)
     weThread = threading.Thread(target=websocketThreadFunc)
     weThread.start()
 
-    httpd = HTTPServer(('', PORT_NUMBER), HTTPHandler)
+    httpd = PooledHTTPServer(('', PORT_NUMBER), HTTPHandler, workers=http_workers)
+    pipelineStats.setGauge("http_busy", lambda: httpd.busy)
+    pipelineStats.setGauge("http_pending", httpd.pending)
     serverThread = threading.Thread(target=httpServerFunc)
     serverThread.start()
 
     postThread = threading.Thread(target=postThreadFunc)
     postThread.start()
 
-    # Run UI
+    # Run UI, SIGTERM (systemctl stop, reboot) stops it like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: _thread.interrupt_main())
     mainView.mainloop()
 
     is_active = False
     httpd.shutdown()
     websocket.shutdown()
+    if messageLog is not None:
+        postThread.join()
+        saveMessagesNow()
+        messageLog.stop()
 
     print("App done")
 
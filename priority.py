@@ -0,0 +1,54 @@
+# Message priority classifier
+#
+# All priority rules are combined into one precompiled pattern. Rules are
+# checked in the order they were added (first rule that matches wins), as
+# only the leading words of the message matter, results are kept in a small
+# LRU cache keyed by these words.
+
+import re
+import threading
+from collections import OrderedDict
+
+
+class PriorityClassifier(object):
+
+    def __init__(self, rules=None, default=0, words=2, cache_size=1024):
+        self.default = default
+        self.words = words
+        self.cache_size = cache_size
+        self.rules = []
+        self.pattern = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        for priority, regex in (rules or []):
+            self.addRule(priority, regex)
+
+    def addRule(self, priority, regex):
+        # Add a regional priority scheme, e.g. addRule(1, r"^PRIO\s?1")
+        with self.lock:
+            self.rules.append((priority, regex))
+            # Each branch is a lookahead over the whole text, so the alternation
+            # keeps the rules order instead of preferring the leftmost match
+            branches = ["(?=.*?(?:{}))(?P<r{}>)".format(rx, p) for p, (pr, rx) in enumerate(self.rules)]
+            self.pattern = re.compile("^(?:" + "|".join(branches) + ")", re.IGNORECASE | re.DOTALL)
+            self.cache.clear()
+
+    def messageStart(self, message):
+        return " ".join(message.split(' ', self.words)[:self.words])
+
+    def classify(self, message):
+        key = self.messageStart(message)
+        with self.lock:
+            priority = self.cache.get(key)
+            if priority is not None:
+                self.cache.move_to_end(key)
+                return priority
+
+            priority = self.default
+            match = self.pattern.match(key) if self.pattern is not None else None
+            if match is not None:
+                priority = self.rules[int(match.lastgroup[1:])][0]
+            self.cache[key] = priority
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return priority
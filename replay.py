@@ -0,0 +1,63 @@
+# Replay of a recorded multimon-ng output, can be used instead of the receiver
+#
+# Record: rtl_fm ... | multimon-ng ... -t raw - | tee capture.log
+# Replay: python3 p2000.py --replay=capture.log [--speed=realtime|10x|max]
+
+import time
+from datetime import datetime
+import msgparser
+
+
+def parseSpeed(speed):
+    # Returns speed multiplier, None means no pacing at all
+    speed = (speed or "max").strip().lower()
+    if speed == "max":
+        return None
+    if speed == "realtime":
+        return 1.0
+    try:
+        value = float(speed[:-1] if speed.endswith("x") else speed)
+    except ValueError:
+        raise ValueError("Replay speed should be realtime, Nx or max: {}".format(speed))
+    if not 0 < value < float("inf"):
+        raise ValueError("Replay speed should be positive: {}".format(speed))
+    return value
+
+
+class ReplaySource(object):
+    # File based replacement of the multimon-ng stdout: readline() returns bytes, b"" at the end
+
+    def __init__(self, filename, speed=None):
+        self.filename = filename
+        self.speed = speed
+        self.file = open(filename, "rb")
+        self.time_first = None
+        self.time_start = None
+
+    def lineTime(self, line):
+        parsed = msgparser.parseLine(line.decode('utf8', 'backslashreplace'))
+        if parsed is None or parsed.timestamp is None:
+            return None
+        try:
+            return datetime.strptime(parsed.timestamp, "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return None
+
+    def readline(self):
+        line = self.file.readline()
+        if len(line) == 0 or self.speed is None:
+            return line
+
+        # Pacing: keep the recorded intervals between messages, divided by speed
+        line_time = self.lineTime(line)
+        if line_time is not None:
+            now = time.monotonic()
+            if self.time_first is None:
+                self.time_first, self.time_start = line_time, now
+            delay = self.time_start + (line_time - self.time_first)/self.speed - now
+            if delay > 0:
+                time.sleep(delay)
+        return line
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,95 @@
+# Pipeline counters and latency statistics
+
+import time
+import threading
+from collections import deque
+
+
+class PipelineStats(object):
+
+    def __init__(self, samples_limit=100000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=samples_limit)
+        self.gauges = dict()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.time_start = time.perf_counter()
+            self.lines = 0
+            self.messages = 0
+            self.dropped = 0
+            self.batches = 0
+            self.batch_max = 0
+            self.devices = dict()
+            self.latencies.clear()
+
+    def setGauge(self, name, getter):
+        # Value that is read only when stats are requested, e.g. the queue depth
+        self.gauges[name] = getter
+
+    def deviceCounters(self, device):
+        counters = self.devices.get(device)
+        if counters is None:
+            counters = {"lines": 0, "decoded": 0, "duplicates": 0}
+            self.devices[device] = counters
+        return counters
+
+    def addLine(self, device=None):
+        with self.lock:
+            self.lines += 1
+            if device is not None:
+                self.deviceCounters(device)["lines"] += 1
+
+    def addDecoded(self, device):
+        with self.lock:
+            self.deviceCounters(device)["decoded"] += 1
+
+    def addDuplicate(self, device):
+        with self.lock:
+            self.deviceCounters(device)["duplicates"] += 1
+
+    def addDropped(self):
+        with self.lock:
+            self.dropped += 1
+
+    def addBatch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batch_max = max(self.batch_max, size)
+
+    def addMessage(self, latency):
+        # Latency: time from reading the line to the message being stored and shown
+        with self.lock:
+            self.messages += 1
+            self.latencies.append(latency)
+
+    def percentile(self, values, p):
+        if len(values) == 0:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values)*p/100.0))]
+
+    def asDict(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.time_start
+            latencies = sorted(self.latencies)
+            data = {"lines": self.lines,
+                    "messages": self.messages,
+                    "dropped": self.dropped,
+                    "batches": self.batches,
+                    "batch_max": self.batch_max,
+                    "elapsed_s": round(elapsed, 3),
+                    "lines_per_s": round(self.lines/elapsed, 1) if elapsed > 0 else 0.0,
+                    "latency_avg_ms": round(1000*sum(latencies)/len(latencies), 3) if len(latencies) > 0 else 0.0,
+                    "latency_p50_ms": round(1000*self.percentile(latencies, 50), 3),
+                    "latency_p99_ms": round(1000*self.percentile(latencies, 99), 3),
+                    "latency_max_ms": round(1000*latencies[-1], 3) if len(latencies) > 0 else 0.0,
+                    "devices": {str(d): dict(c) for d, c in self.devices.items()}}
+        for name, getter in self.gauges.items():
+            data[name] = getter()
+        return data
+
+    def report(self):
+        data = self.asDict()
+        print("Lines: {}, messages: {}, dropped: {}, time: {}s, throughput: {} lines/s".format(data["lines"], data["messages"], data["dropped"], data["elapsed_s"], data["lines_per_s"]))
+        print("Latency: avg {}ms, p50 {}ms, p99 {}ms, max {}ms".format(data["latency_avg_ms"], data["latency_p50_ms"], data["latency_p99_ms"], data["latency_max_ms"]))
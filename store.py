@@ -0,0 +1,100 @@
+# Fixed-capacity ring buffer for received messages
+#
+# Append and eviction of the oldest message are O(1), messages get monotonically
+# increasing ids. Index 0 is the newest message, like in the old list.
+#
+# The version counter is increased on every change (new, merged or posted
+# message), it is used as the HTTP ETag of the messages list.
+
+import time
+import threading
+
+
+class MessageStore(object):
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.slots = [None]*self.capacity
+        self.start = 0   # position of the oldest message
+        self.count = 0
+        self.last_id = 0
+        self.epoch_max = 0
+        self.version = 0
+        self.modified = time.time()
+        self.created = int(self.modified)  # versions restart from 0 with the app
+        self.lock = threading.RLock()
+
+    def append(self, msg):
+        # Add a new message, returns the evicted (oldest) message or None
+        with self.lock:
+            if msg.id is None or msg.id <= self.last_id:
+                msg.id = self.last_id + 1
+            self.last_id = msg.id
+            # Message times are not ordered (decoder time for FLEX, clock time for POCSAG), their running maximum is
+            self.epoch_max = max(self.epoch_max, msg.epoch)
+            msg.epoch_max = self.epoch_max
+            self.touch()
+
+            evicted = None
+            if self.count < self.capacity:
+                self.slots[(self.start + self.count) % self.capacity] = msg
+                self.count += 1
+            else:
+                evicted = self.slots[self.start]
+                self.slots[self.start] = msg
+                self.start = (self.start + 1) % self.capacity
+            return evicted
+
+    def touch(self):
+        # Should be called after a stored message was changed
+        with self.lock:
+            self.version += 1
+            self.modified = time.time()
+
+    def versionTag(self):
+        return "{:x}-{:x}".format(self.created, self.version)
+
+    def __len__(self):
+        return self.count
+
+    def at(self, pos):
+        # Message by position from the oldest one
+        return self.slots[(self.start + pos) % self.capacity]
+
+    def __getitem__(self, index):
+        with self.lock:
+            if isinstance(index, slice):
+                return [self[p] for p in range(*index.indices(self.count))]
+            if index < 0:
+                index += self.count
+            if index < 0 or index >= self.count:
+                raise IndexError("message index out of range")
+            return self.at(self.count - 1 - index)
+
+    def newest(self, limit=None):
+        # List of messages, newest first
+        with self.lock:
+            n = self.count if limit is None else min(limit, self.count)
+            return [self.at(self.count - 1 - p) for p in range(n)]
+
+    def __iter__(self):
+        # Iterate over a snapshot, so appending from other threads is safe
+        return iter(self.newest())
+
+    def positionOf(self, msg_id):
+        # Position (from the oldest) of the first message with id >= msg_id
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self.at(mid).id < msg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def getById(self, msg_id):
+        with self.lock:
+            pos = self.positionOf(msg_id)
+            if pos < self.count and self.at(pos).id == msg_id:
+                return self.at(pos)
+            return None
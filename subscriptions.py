@@ -0,0 +1,297 @@
+# Websocket subscriptions: which new messages a client wants to get
+#
+# A client sends {"subscribe": {"capcodes": ["00118*", "001234567"], "priority": 2,
+# "senders": [1, 3], "keywords": ["brand", "amster*"]}}. All given fields should
+# match, a list matches if any of its items does. Priority 2 means A1 and A2
+# messages (1 is the most urgent). Clients without a subscription get everything.
+#
+# Every subscription is indexed by one field only, the most selective one
+# (capcodes, keywords, senders, priority in this order). For a new message the
+# candidate clients are found by lookups in these indexes, only the candidates
+# check their other fields, so the cost does not depend on the number of clients
+# which are not interested in the message.
+#
+# Benchmark: python3 subscriptions.py [--clients=1000] [--messages=10000]
+
+import re
+import time
+import random
+import fnmatch
+import argparse
+import threading
+from filters import PrefixTrie, isPrefixPattern, isExactPattern
+from msgindex import tokenize, TOKEN_REGEX
+from message import MessageItem
+
+MAX_ITEMS = 1000  # patterns, senders or keywords per subscription
+
+
+class Subscription(object):
+    __slots__ = ['client_id', 'capcodes', 'priority', 'senders', 'keywords']
+
+    def __init__(self, client_id, capcodes=None, priority=None, senders=None, keywords=None):
+        self.client_id = client_id
+        self.capcodes = capcodes
+        self.priority = priority
+        self.senders = senders
+        self.keywords = keywords
+
+    def isEmpty(self):
+        return self.capcodes is None and self.priority is None and self.senders is None and self.keywords is None
+
+    def hasKeyword(self, words):
+        for keyword in self.keywords:
+            if keyword.endswith('*'):
+                prefix = keyword[:-1]
+                if any(w.startswith(prefix) for w in words):
+                    return True
+            elif keyword in words:
+                return True
+        return False
+
+    def matches(self, msg, words):
+        # All fields except capcodes: if a subscription has capcodes, they are checked by the index
+        return (self.priority is None or 0 < msg.priority <= self.priority) and \
+               (self.senders is None or msg.sender in self.senders) and \
+               (self.keywords is None or self.hasKeyword(words))
+
+    def matchesCapcodes(self, msg):
+        if self.capcodes is None:
+            return True
+        return any(fnmatch.fnmatchcase(capcode, pattern) for capcode in msg.capcodesText() for pattern in self.capcodes)
+
+    def toDict(self):
+        return {"capcodes": self.capcodes,
+                "priority": self.priority,
+                "senders": sorted(self.senders) if self.senders is not None else None,
+                "keywords": self.keywords}
+
+
+def parseList(data, name, itemType):
+    # None or a not empty list of unique items
+    value = data.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, list) or any(not isinstance(item, itemType) or isinstance(item, bool) for item in value):
+        raise ValueError("'{}' should be a list of {}".format(name, "strings" if itemType is str else "numbers"))
+    if len(value) > MAX_ITEMS:
+        raise ValueError("'{}' has more than {} items".format(name, MAX_ITEMS))
+    return sorted(set(value)) if len(value) > 0 else None
+
+
+def parseSubscription(client_id, data):
+    # Subscription from the client JSON, ValueError if it is not valid
+    if data is None:
+        data = dict()
+    if not isinstance(data, dict):
+        raise ValueError("Subscription should be an object")
+    unknown = set(data.keys()) - {"capcodes", "priority", "senders", "keywords"}
+    if len(unknown) > 0:
+        raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+
+    capcodes = parseList(data, "capcodes", str)
+    if capcodes is not None:
+        capcodes = sorted(set(c.strip() for c in capcodes if len(c.strip()) > 0)) or None
+    priority = data.get("priority")
+    if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool) or priority < 1):
+        raise ValueError("'priority' should be a number from 1")
+    senders = parseList(data, "senders", int)
+    keywords = parseList(data, "keywords", str)
+    if keywords is not None:
+        keywords = sorted(set(k.strip().lower() for k in keywords))
+        for keyword in keywords:
+            if TOKEN_REGEX.fullmatch(keyword.rstrip('*')) is None or keyword.count('*') > 1:
+                raise ValueError("Keyword '{}' should be one word, or a word prefix with '*'".format(keyword))
+    return Subscription(client_id, capcodes, priority, frozenset(senders) if senders is not None else None, keywords)
+
+
+def addToSet(index, key, client_id):
+    ids = index.get(key)
+    if ids is None:
+        ids = set()
+        index[key] = ids
+    ids.add(client_id)
+
+
+def removeFromSet(index, key, client_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(client_id)
+        if len(ids) == 0:
+            del index[key]
+
+
+class SubscriptionIndex(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.everything = set()       # connected clients without a subscription
+        self.subscriptions = dict()   # client id => Subscription
+        self.capcode_exact = dict()   # capcode => client ids
+        self.capcode_prefixes = PrefixTrie()
+        self.capcode_patterns = []    # (regex, client id) for other wildcard patterns
+        self.keyword_exact = dict()   # word => client ids
+        self.keyword_prefixes = PrefixTrie()
+        self.by_sender = dict()       # sender type => client ids
+        self.by_priority = dict()     # priority => client ids, for messages with this or higher priority
+
+    def addClient(self, client_id):
+        with self.lock:
+            self.everything.add(client_id)
+
+    def removeClient(self, client_id):
+        with self.lock:
+            self.everything.discard(client_id)
+            self.removeSubscription(client_id)
+
+    def subscribe(self, subscription):
+        # Replaces the previous subscription of the client, an empty one is the same as none
+        client_id = subscription.client_id
+        with self.lock:
+            self.removeSubscription(client_id)
+            if subscription.isEmpty():
+                self.everything.add(client_id)
+                return
+            self.everything.discard(client_id)
+            self.subscriptions[client_id] = subscription
+            self.indexSubscription(subscription, True)
+
+    def unsubscribe(self, client_id):
+        with self.lock:
+            self.removeSubscription(client_id)
+            self.everything.add(client_id)
+
+    def removeSubscription(self, client_id):
+        # Should be called with the lock held
+        subscription = self.subscriptions.pop(client_id, None)
+        if subscription is not None:
+            self.indexSubscription(subscription, False)
+
+    def indexSubscription(self, subscription, add):
+        client_id = subscription.client_id
+        if subscription.capcodes is not None:
+            for pattern in subscription.capcodes:
+                if isExactPattern(pattern):
+                    (addToSet if add else removeFromSet)(self.capcode_exact, pattern, client_id)
+                elif isPrefixPattern(pattern):
+                    if add:
+                        self.capcode_prefixes.add(pattern[:-1], client_id)
+                    else:
+                        self.capcode_prefixes.remove(pattern[:-1], client_id)
+                elif add:
+                    self.capcode_patterns.append((re.compile(fnmatch.translate(pattern)), client_id))
+            if not add:
+                self.capcode_patterns = [(regex, c) for regex, c in self.capcode_patterns if c != client_id]
+        elif subscription.keywords is not None:
+            for keyword in subscription.keywords:
+                if not keyword.endswith('*'):
+                    (addToSet if add else removeFromSet)(self.keyword_exact, keyword, client_id)
+                elif add:
+                    self.keyword_prefixes.add(keyword[:-1], client_id)
+                else:
+                    self.keyword_prefixes.remove(keyword[:-1], client_id)
+        elif subscription.senders is not None:
+            for sender in subscription.senders:
+                (addToSet if add else removeFromSet)(self.by_sender, sender, client_id)
+        else:
+            (addToSet if add else removeFromSet)(self.by_priority, subscription.priority, client_id)
+
+    def recipients(self, msg):
+        # Ids of clients which should get the message, None if there are no subscriptions (everybody)
+        with self.lock:
+            if len(self.subscriptions) == 0:
+                return None
+            words = tokenize(msg.body)
+            candidates = set()
+            if len(self.capcode_exact) > 0 or len(self.capcode_prefixes) > 0 or len(self.capcode_patterns) > 0:
+                for capcode in msg.capcodesText():
+                    candidates.update(self.capcode_exact.get(capcode, ()))
+                    candidates.update(self.capcode_prefixes.match(capcode))
+                    for regex, client_id in self.capcode_patterns:
+                        if regex.match(capcode) is not None:
+                            candidates.add(client_id)
+            if len(self.keyword_exact) > 0 or len(self.keyword_prefixes) > 0:
+                for word in words:
+                    candidates.update(self.keyword_exact.get(word, ()))
+                    candidates.update(self.keyword_prefixes.match(word))
+            candidates.update(self.by_sender.get(msg.sender, ()))
+            if msg.priority > 0:
+                for priority, ids in self.by_priority.items():
+                    if msg.priority <= priority:
+                        candidates.update(ids)
+
+            result = set(self.everything)
+            for client_id in candidates:
+                if self.subscriptions[client_id].matches(msg, words):
+                    result.add(client_id)
+        return result
+
+    def isRecipient(self, client_id, msg):
+        # Check of one client, without the index (messages replayed on resume)
+        with self.lock:
+            subscription = self.subscriptions.get(client_id)
+        if subscription is None:
+            return True
+        words = tokenize(msg.body) if subscription.keywords is not None else None
+        return subscription.matchesCapcodes(msg) and subscription.matches(msg, words)
+
+    def stats(self):
+        with self.lock:
+            return {"subscribed": len(self.subscriptions), "unfiltered": len(self.everything)}
+
+
+# Benchmark
+
+def benchmark(clients, messages_count):
+    # Clients subscribe to a few random capcodes or prefixes, some to keywords or priority
+    rnd = random.Random(1)
+    capcodes = ["{:09d}".format(rnd.randrange(100000, 2000000)) for p in range(5000)]
+    words = ["brand", "ambu", "amsterdam", "rotterdam", "utrecht", "haarlem", "leiden", "gouda", "delft", "zwolle"]
+    index = SubscriptionIndex()
+    subscriptions = []
+    for client_id in range(clients):
+        kind = client_id % 10
+        if kind < 7:
+            patterns = [rnd.choice(capcodes) for p in range(3)] + [rnd.choice(capcodes)[:6] + "*"]
+            sub = parseSubscription(client_id, {"capcodes": patterns, "priority": 2 if kind == 0 else None})
+        elif kind < 9:
+            sub = parseSubscription(client_id, {"keywords": [rnd.choice(words), rnd.choice(words)[:4] + "*"]})
+        else:
+            sub = parseSubscription(client_id, {"priority": 1})
+        index.addClient(client_id)
+        index.subscribe(sub)
+        subscriptions.append(sub)
+
+    msgs = []
+    for p in range(messages_count):
+        msg = MessageItem()
+        msg.body = "A{} {} {} {}".format(rnd.randint(1, 2), rnd.choice(words), rnd.choice(words), p)
+        msg.priority = rnd.randint(0, 4)
+        for capcode in rnd.sample(capcodes, 3):
+            msg.addCapcode(int(capcode))
+        msgs.append(msg)
+
+    # Index lookups against testing every subscription
+    time_start = time.perf_counter()
+    routed = sum(len(index.recipients(msg)) for msg in msgs)
+    elapsed_index = time.perf_counter() - time_start
+    time_start = time.perf_counter()
+    checked = 0
+    for msg in msgs:
+        words_set = tokenize(msg.body)
+        for sub in subscriptions:
+            if sub.matchesCapcodes(msg) and sub.matches(msg, words_set):
+                checked += 1
+    elapsed_linear = time.perf_counter() - time_start
+
+    print("Clients: {}, messages: {}, deliveries: {} ({:.1f} per message)".format(clients, messages_count, routed, routed/messages_count))
+    print("Index: {:.1f}us per message, every subscription: {:.1f}us per message{}".format(
+          1e6*elapsed_index/messages_count, 1e6*elapsed_linear/messages_count, "" if checked == routed else ", results differ!"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", dest="clients", type=int, default=1000)
+    parser.add_argument("--messages", dest="messages", type=int, default=10000)
+    args = parser.parse_args()
+    benchmark(args.clients, args.messages)
@@ -2,17 +2,23 @@
 # License: MIT
 
 import sys
+import time
+import zlib
 import struct
+import threading
 from base64 import b64encode
 from hashlib import sha1
 import logging
+import socket
 from socket import error as SocketError
 import errno
 
 if sys.version_info[0] < 3:
     from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    import Queue as queue
 else:
     from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    import queue
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
@@ -34,6 +40,7 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -47,6 +54,19 @@ OPCODE_CLOSE_CONN   = 0x8
 OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
 
+# What to do with a client whose send queue is full
+SLOW_CLIENT_DROP = 'drop'  # disconnect it, the client can reconnect and resync
+SLOW_CLIENT_LAG  = 'lag'   # skip its oldest queued messages
+# A client is slow if its writer is blocked in one send for this time (s)
+SEND_STALL_TIMEOUT = 1.0
+# Largest accepted client message, all fragments together (bytes)
+MAX_MESSAGE_SIZE = 1024*1024
+
+# permessage-deflate (RFC 7692): compressed messages end with this empty block,
+# which is not sent
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+DEFLATE_LEVEL = 6
+
 
 # -------------------------------- API ---------------------------------
 
@@ -87,6 +107,9 @@ class API():
     def send_message_to_all(self, msg):
         self._multicast_(msg)
 
+    def send_message_to_clients(self, client_ids, msg):
+        self._multicast_(msg, client_ids)
+
 
 # ------------------------- Implementation -----------------------------
 
@@ -101,6 +124,17 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             0.0.0.0.
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
+        send_queue_size(int): Messages queued per client. Every client has its own
+            writer thread, so a stalled client does not delay the others.
+        slow_client_policy(str): SLOW_CLIENT_DROP or SLOW_CLIENT_LAG, applied
+            when the send queue of a client is full.
+        deflate(bool): Accept the permessage-deflate extension offered by clients.
+        deflate_shared(bool): Compress every broadcast message once for all
+            clients (no context takeover), or keep a compression context per
+            client: better ratio for similar messages, but each client costs
+            a compression. Clients which ask for server_no_context_takeover
+            always get messages compressed without a context.
+        deflate_min_size(int): Smaller messages are sent uncompressed.
 
     Properties:
         clients(list): A list of connected clients. A client is a dictionary
@@ -118,8 +152,24 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
     clients = []
     id_counter = 0
 
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING,
+                 send_queue_size=100, slow_client_policy=SLOW_CLIENT_DROP,
+                 deflate=True, deflate_shared=True, deflate_min_size=128):
         logger.setLevel(loglevel)
+        self.clients = []
+        self.clients_by_id = {}
+        self.clients_lock = threading.Lock()
+        self.send_queue_size = send_queue_size
+        self.slow_client_policy = slow_client_policy
+        self.slow_clients_dropped = 0
+        self.broadcasts = 0
+        self.deflate = deflate
+        self.deflate_shared = deflate_shared
+        self.deflate_min_size = deflate_min_size
+        # Sent payloads before and after compression, all clients
+        self.stats_lock = threading.Lock()
+        self.payload_bytes = 0
+        self.sent_bytes = 0
         TCPServer.__init__(self, (host, port), WebSocketHandler)
         self.port = self.socket.getsockname()[1]
 
@@ -133,32 +183,83 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         pass
 
     def _new_client_(self, handler):
-        self.id_counter += 1
-        client = {
-            'id': self.id_counter,
-            'handler': handler,
-            'address': handler.client_address
-        }
-        self.clients.append(client)
+        with self.clients_lock:
+            self.id_counter += 1
+            client = {
+                'id': self.id_counter,
+                'handler': handler,
+                'address': handler.client_address
+            }
+            self.clients.append(client)
+            self.clients_by_id[client['id']] = client
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
+        if client is None:
+            return
         self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
+        with self.clients_lock:
+            if client in self.clients:
+                self.clients.remove(client)
+            self.clients_by_id.pop(client['id'], None)
 
     def _unicast_(self, to_client, msg):
         to_client['handler'].send_message(msg)
 
-    def _multicast_(self, msg):
-        for client in self.clients:
-            self._unicast_(client, msg)
+    def _multicast_(self, msg, client_ids=None):
+        # The frame is built once and queued to every client, or to the given clients only
+        payload = encode_message(msg)
+        if payload is None:
+            return
+        frame = frame_bytes(payload)
+        deflated = None
+        with self.clients_lock:
+            if client_ids is None:
+                clients = list(self.clients)
+            else:
+                clients = [self.clients_by_id[i] for i in client_ids if i in self.clients_by_id]
+        self.broadcasts += 1
+        for client in clients:
+            handler = client['handler']
+            if not handler.deflate or len(payload) < self.deflate_min_size:
+                handler.send_frame(frame, payload)
+            elif handler.compressor is not None:
+                # Compressed by the writer thread, with the client context
+                handler.send_frame(None, payload)
+            else:
+                # Compressed once, at the first client that needs it (no context takeover)
+                if deflated is None:
+                    deflated = deflate_frame(payload)
+                    if len(deflated) >= len(frame):
+                        deflated = frame
+                handler.send_frame(deflated, payload)
 
     def handler_to_client(self, handler):
-        for client in self.clients:
-            if client['handler'] == handler:
-                return client
+        with self.clients_lock:
+            for client in self.clients:
+                if client['handler'] == handler:
+                    return client
+
+    def clients_stats(self):
+        """
+        Send queue metrics: backlog (queued now), backlog_max, sent messages and
+        bytes, skipped messages (lag policy) of every client. payload_bytes is
+        the size of the sent messages before compression.
+        """
+        with self.clients_lock:
+            clients = list(self.clients)
+        return {
+            'clients': len(clients),
+            'broadcasts': self.broadcasts,
+            'slow_clients_dropped': self.slow_clients_dropped,
+            'deflate_clients': sum(1 for client in clients if client['handler'].deflate),
+            'payload_bytes': self.payload_bytes,
+            'sent_bytes': self.sent_bytes,
+            'saved_percent': round(100.0*(1 - self.sent_bytes/float(self.payload_bytes)), 1) if self.payload_bytes > 0 else 0.0,
+            'per_client': [dict(client['handler'].send_stats(), id=client['id'],
+                                address='%s:%d' % client['address'][:2]) for client in clients]
+        }
 
 
 class WebSocketHandler(StreamRequestHandler):
@@ -172,6 +273,22 @@ class WebSocketHandler(StreamRequestHandler):
         self.keep_alive = True
         self.handshake_done = False
         self.valid_client = False
+        self.send_queue = queue.Queue(maxsize=self.server.send_queue_size)
+        self.send_lock = threading.Lock()
+        self.writer = None
+        self.sent = 0
+        self.sent_bytes = 0
+        self.skipped = 0
+        self.backlog_max = 0
+        self.send_started = None  # time of the current send, None if the writer is not sending
+        self.fragments = None     # payloads of a fragmented message received so far
+        self.fragments_opcode = OPCODE_TEXT
+        self.fragments_compressed = False
+        self.fragments_size = 0
+        self.deflate = False      # permessage-deflate is negotiated
+        self.compressor = None    # per client compression context, if the server keeps it between messages
+        self.decompressor = None
+        self.payload_bytes = 0
 
     def handle(self):
         while self.keep_alive:
@@ -202,6 +319,7 @@ class WebSocketHandler(StreamRequestHandler):
             b1, b2 = 0, 0
 
         fin    = b1 & FIN
+        rsv1   = b1 & RSV1
         opcode = b1 & OPCODE
         masked = b2 & MASKED
         payload_length = b2 & PAYLOAD_LEN
@@ -214,18 +332,27 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warn("Client must always be masked.")
             self.keep_alive = 0
             return
-        if opcode == OPCODE_CONTINUATION:
-            logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warn("Binary frames are not supported.")
+        if rsv1 and (not self.deflate or opcode not in (OPCODE_TEXT, OPCODE_BINARY)):
+            # Only the first frame of a compressed message has RSV1
+            logger.warn("Unexpected RSV1 bit.")
+            self.keep_alive = 0
             return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
-        elif opcode == OPCODE_PING:
-            opcode_handler = self.server._ping_received_
-        elif opcode == OPCODE_PONG:
-            opcode_handler = self.server._pong_received_
+        if opcode == OPCODE_CONTINUATION:
+            if self.fragments is None:
+                logger.warn("Continuation frame without a message to continue.")
+                self.keep_alive = 0
+                return
+        elif opcode == OPCODE_TEXT or opcode == OPCODE_BINARY:
+            if self.fragments is not None:
+                logger.warn("New message before the end of a fragmented message.")
+                self.keep_alive = 0
+                return
+        elif opcode == OPCODE_PING or opcode == OPCODE_PONG:
+            # Control frames can come between fragments, but can not be fragmented
+            if not fin or payload_length > 125:
+                logger.warn("Invalid control frame.")
+                self.keep_alive = 0
+                return
         else:
             logger.warn("Unknown opcode %#x." % opcode)
             self.keep_alive = 0
@@ -235,13 +362,69 @@ class WebSocketHandler(StreamRequestHandler):
             payload_length = struct.unpack(">H", self.rfile.read(2))[0]
         elif payload_length == 127:
             payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
+        if self.fragments_size + payload_length > MAX_MESSAGE_SIZE:
+            logger.warn("Message is too big (%d bytes)." % (self.fragments_size + payload_length))
+            self.keep_alive = 0
+            return
 
-        masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8'))
+        # Mask and payload are read at once
+        data = self.rfile.read(4 + payload_length)
+        if len(data) < 4 + payload_length:
+            logger.info("Client closed connection.")
+            self.keep_alive = 0
+            return
+        payload = unmask(memoryview(data)[4:], data[:4])
+
+        if opcode == OPCODE_PING:
+            self.server._ping_received_(self, payload.decode('utf8', 'replace'))
+            return
+        if opcode == OPCODE_PONG:
+            self.server._pong_received_(self, payload.decode('utf8', 'replace'))
+            return
+
+        # Fragmented message: the first frame has the opcode, the last one has FIN
+        if opcode == OPCODE_CONTINUATION or not fin:
+            if opcode != OPCODE_CONTINUATION:
+                self.fragments = []
+                self.fragments_opcode = opcode
+                self.fragments_compressed = bool(rsv1)
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+            if not fin:
+                return
+            payload = b''.join(self.fragments)
+            opcode = self.fragments_opcode
+            rsv1 = self.fragments_compressed
+            self.fragments = None
+            self.fragments_size = 0
+
+        if rsv1:
+            payload = self.inflate(payload)
+            if payload is None:
+                self.keep_alive = 0
+                return
+
+        if opcode == OPCODE_BINARY:
+            logger.warn("Binary frames are not supported.")
+            return
+        message = try_decode_UTF8(payload)
+        if message is False:
+            logger.warn("Client message is not valid UTF-8.")
+            self.keep_alive = 0
+            return
+        self.server._message_received_(self, message)
+
+    def inflate(self, payload):
+        # Compressed client message, or None if it is invalid or too big
+        try:
+            data = self.decompressor.decompress(payload + DEFLATE_TAIL, MAX_MESSAGE_SIZE)
+        except zlib.error as e:
+            logger.warn("Can't decompress client message: %s" % e)
+            return None
+        if self.decompressor.unconsumed_tail:
+            logger.warn("Message is too big (more than %d bytes)." % MAX_MESSAGE_SIZE)
+            return None
+        return data
 
     def send_message(self, message):
         self.send_text(message)
@@ -254,47 +437,112 @@ class WebSocketHandler(StreamRequestHandler):
         Important: Fragmented(=continuation) messages are not supported since
         their usage cases are limited - when we don't know the payload length.
         """
-
-        # Validate message
-        if isinstance(message, bytes):
-            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
-            if not message:
-                logger.warning("Can\'t send message, message is not valid UTF-8")
-                return False
-        elif sys.version_info < (3,0) and (isinstance(message, str) or isinstance(message, unicode)):
-            pass
-        elif isinstance(message, str):
-            pass
-        else:
-            logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+        payload = encode_message(message)
+        if payload is None:
             return False
+        if opcode != OPCODE_TEXT or not self.deflate or len(payload) < self.server.deflate_min_size:
+            return self.send_frame(frame_bytes(payload, opcode), payload)
+        if self.compressor is not None:
+            return self.send_frame(None, payload)
+        return self.send_frame(deflate_frame(payload), payload)
 
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
-        payload_length = len(payload)
-
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
-
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
-
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
-
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
+    def send_frame(self, frame, payload):
+        """
+        Queue a ready frame for the writer thread, or only the payload (frame is
+        None) to be compressed with the client context. If the queue is full,
+        the slow client policy of the server is applied.
+        """
+        if not self.keep_alive:
+            return False
+        item = (frame, payload)
+        with self.send_lock:
+            try:
+                self.send_queue.put_nowait(item)
+            except queue.Full:
+                # A working writer only needs a moment to catch up after a burst
+                try:
+                    send_started = self.send_started
+                    if send_started is not None and time.time() - send_started >= SEND_STALL_TIMEOUT:
+                        raise queue.Full
+                    self.send_queue.put(item, timeout=SEND_STALL_TIMEOUT)
+                    self.backlog_max = max(self.backlog_max, self.send_queue.qsize())
+                    return True
+                except queue.Full:
+                    pass
+                if self.server.slow_client_policy == SLOW_CLIENT_LAG:
+                    # Skip the oldest message, the newest one is queued. Messages are
+                    # compressed after the queue, so the client context stays valid
+                    try:
+                        self.send_queue.get_nowait()
+                        self.skipped += 1
+                    except queue.Empty:
+                        pass
+                    self.send_queue.put_nowait(item)
+                else:
+                    logger.warning("Client %s is too slow, disconnected." % (self.client_address,))
+                    self.server.slow_clients_dropped += 1
+                    self.close_connection()
+                    return False
+            self.backlog_max = max(self.backlog_max, self.send_queue.qsize())
+        return True
+
+    def writer_thread(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                break
+            frame, payload = item
+            if frame is None:
+                frame = deflate_frame(payload, self.compressor)
+            self.send_started = time.time()
+            try:
+                self.request.sendall(frame)
+                self.sent += 1
+                self.sent_bytes += len(frame)
+                self.payload_bytes += len(payload)
+                with self.server.stats_lock:
+                    self.server.sent_bytes += len(frame)
+                    self.server.payload_bytes += len(payload)
+            except (SocketError, OSError) as e:
+                logger.info("Send error: %s" % e)
+                self.close_connection()
+                break
+            finally:
+                self.send_started = None
+
+    def start_writer(self):
+        self.writer = threading.Thread(target=self.writer_thread)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop_writer(self):
+        # Unblock the writer, queued messages are not needed anymore
+        with self.send_lock:
+            while True:
+                try:
+                    self.send_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.send_queue.put_nowait(None)
+
+    def close_connection(self):
+        # Both directions, the reading thread gets EOF and finishes the client
+        self.keep_alive = False
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except (SocketError, OSError):
+            pass
 
-        self.request.send(header + payload)
+    def send_stats(self):
+        return {
+            'backlog': self.send_queue.qsize(),
+            'backlog_max': self.backlog_max,
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'payload_bytes': self.payload_bytes,
+            'skipped': self.skipped,
+            'deflate': self.deflate
+        }
 
     def read_http_headers(self):
         headers = {}
@@ -307,7 +555,9 @@ class WebSocketHandler(StreamRequestHandler):
             if not header:
                 break
             head, value = header.split(':', 1)
-            headers[head.lower().strip()] = value.strip()
+            head = head.lower().strip()
+            # A repeated header is the same as one comma-separated list
+            headers[head] = headers[head] + ', ' + value.strip() if head in headers else value.strip()
         return headers
 
     def handshake(self):
@@ -326,19 +576,57 @@ class WebSocketHandler(StreamRequestHandler):
             self.keep_alive = False
             return
 
-        response = self.make_handshake_response(key)
+        extensions = None
+        if self.server.deflate:
+            extensions = self.accept_deflate(headers.get('sec-websocket-extensions', ''))
+        if extensions is not None:
+            self.deflate = True
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            # The context is kept only if the response allows it (RFC 7692, 7.1.1.1)
+            if 'server_no_context_takeover' not in extensions:
+                self.compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        response = self.make_handshake_response(key, extensions)
         self.handshake_done = self.request.send(response.encode())
         self.valid_client = True
+        self.start_writer()
         self.server._new_client_(self)
 
+    def accept_deflate(self, offers):
+        """
+        Sec-WebSocket-Extensions response value for the first acceptable
+        permessage-deflate offer, or None.
+        """
+        for offer in offers.split(','):
+            params = [p.strip() for p in offer.split(';')]
+            if params[0].lower() != 'permessage-deflate':
+                continue
+            names = dict((p.split('=', 1)[0].strip().lower(), p.split('=', 1)[1].strip().strip('"') if '=' in p else None)
+                         for p in params[1:] if p)
+            # Messages are compressed with the full window, the client may use any
+            if names.get('server_max_window_bits') not in (None, '15'):
+                continue
+            if any(name not in ('server_no_context_takeover', 'client_no_context_takeover',
+                                'server_max_window_bits', 'client_max_window_bits') for name in names):
+                continue
+            response = ['permessage-deflate']
+            if self.server.deflate_shared or 'server_no_context_takeover' in names:
+                response.append('server_no_context_takeover')
+            if 'client_no_context_takeover' in names:
+                response.append('client_no_context_takeover')
+            return '; '.join(response)
+        return None
+
     @classmethod
-    def make_handshake_response(cls, key):
+    def make_handshake_response(cls, key, extensions=None):
         return \
           'HTTP/1.1 101 Switching Protocols\r\n'\
           'Upgrade: websocket\r\n'              \
           'Connection: Upgrade\r\n'             \
           'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % cls.calculate_response_key(key)
+          '%s'                                   \
+          '\r\n' % (cls.calculate_response_key(key),
+                    'Sec-WebSocket-Extensions: %s\r\n' % extensions if extensions else '')
 
     @classmethod
     def calculate_response_key(cls, key):
@@ -348,9 +636,95 @@ class WebSocketHandler(StreamRequestHandler):
         return response_key.decode('ASCII')
 
     def finish(self):
+        self.keep_alive = False
+        self.stop_writer()
         self.server._client_left_(self)
 
 
+def encode_message(message):
+    """
+    UTF-8 payload of a text message, or None if the message is not valid.
+    """
+    # Validate message
+    if isinstance(message, bytes):
+        if try_decode_UTF8(message) is False:  # this is slower but ensures we have UTF-8
+            logger.warning("Can\'t send message, message is not valid UTF-8")
+            return None
+        return message
+    elif sys.version_info < (3,0) and (isinstance(message, str) or isinstance(message, unicode)):
+        pass
+    elif isinstance(message, str):
+        pass
+    else:
+        logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+        return None
+    payload = encode_to_UTF8(message)
+    return payload if payload is not False else None
+
+
+def frame_bytes(payload, opcode=OPCODE_TEXT, rsv1=False):
+    """
+    Unmasked server frame: header and payload.
+    """
+    header  = bytearray()
+    payload_length = len(payload)
+    first = FIN | opcode | (RSV1 if rsv1 else 0)
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(first)
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(first)
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(first)
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+    return bytes(header + payload)
+
+
+def deflate_frame(payload, compressor=None):
+    """
+    Compressed text frame (RSV1 set). Without a compressor every message is
+    compressed on its own (no context takeover) and the frame can be sent to
+    any client which negotiated permessage-deflate.
+    """
+    if compressor is None:
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if data.endswith(DEFLATE_TAIL):
+        data = data[:-len(DEFLATE_TAIL)]
+    return frame_bytes(data, OPCODE_TEXT, True)
+
+
+def unmask(payload, mask):
+    """
+    Payload XOR the 4 byte mask, as bytes. The whole payload is XORed as one
+    big integer, which is much faster than a loop over the bytes.
+    """
+    length = len(payload)
+    if sys.version_info[0] < 3:
+        masks = bytearray(mask)
+        message_bytes = bytearray(payload)
+        for i in range(length):
+            message_bytes[i] ^= masks[i % 4]
+        return bytes(message_bytes)
+    if length == 0:
+        return b''
+    key = (bytes(mask) * (length//4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
 def encode_to_UTF8(data):
     try:
         return data.encode('UTF-8')
@@ -369,3 +743,107 @@ def try_decode_UTF8(data):
         return False
     except Exception as e:
         raise(e)
+
+
+# ---------------------------- Benchmark -------------------------------
+# To run: python3 websocket_server.py [--size 65536] [--seconds 1]
+
+def unmask_bytewise(payload, mask):
+    # The previous per-byte loop, for comparison
+    masks = bytearray(mask)
+    message_bytes = bytearray()
+    for message_byte in bytearray(payload):
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return bytes(message_bytes)
+
+
+def client_frame(payload, mask, opcode=OPCODE_TEXT, fin=True):
+    # Masked frame, as a browser sends it
+    header = bytearray()
+    header.append((FIN if fin else 0) | opcode)
+    if len(payload) <= 125:
+        header.append(MASKED | len(payload))
+    elif len(payload) <= 65535:
+        header.append(MASKED | PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", len(payload)))
+    else:
+        header.append(MASKED | PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", len(payload)))
+    return bytes(header) + mask + unmask(payload, mask)
+
+
+class BenchServer(object):
+
+    def __init__(self):
+        self.received = []
+
+    def _message_received_(self, handler, msg):
+        self.received.append(msg)
+
+
+def bench_reader(data):
+    # Handler reading frames from memory instead of a socket
+    handler = WebSocketHandler.__new__(WebSocketHandler)
+    handler.server = BenchServer()
+    handler.rfile = io.BytesIO(data)
+    handler.keep_alive = True
+    handler.fragments = None
+    handler.fragments_opcode = OPCODE_TEXT
+    handler.fragments_size = 0
+    handler.fragments_compressed = False
+    handler.deflate = False
+    return handler
+
+
+def bench_read(data):
+    # Frames are read one by one, like in handle()
+    handler = bench_reader(data)
+    while handler.keep_alive and len(handler.server.received) == 0:
+        handler.read_next_message()
+    return handler.server.received
+
+
+def bench_rate(func, size, seconds):
+    # MB/s of func(), called for at least the given time
+    count = 0
+    time_start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - time_start
+        if elapsed >= seconds:
+            return count*size/elapsed/1e6
+
+
+if __name__ == "__main__":
+    import io
+    import os
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", dest="size", type=int, default=0, help="Payload size, by default several sizes are tested")
+    parser.add_argument("--seconds", dest="seconds", type=float, default=1.0, help="Time per test")
+    args = parser.parse_args()
+
+    mask = os.urandom(4)
+    sizes = [args.size] if args.size > 0 else [16, 125, 4096, 65536, MAX_MESSAGE_SIZE]
+    for size in sizes:
+        text = (u"P2000 A1 Amsterdam 1012AB " * (size//26 + 1))[:size]
+        payload = text.encode('utf-8')
+        masked = unmask(payload, mask)
+        assert unmask(masked, mask) == payload and unmask_bytewise(masked, mask) == payload
+
+        # One message in 4 fragments, must give the same text
+        step = max(1, size//4)
+        parts = [payload[p:p + step] for p in range(0, size, step)]
+        frames = b''.join(client_frame(part, mask, OPCODE_TEXT if n == 0 else OPCODE_CONTINUATION, n == len(parts) - 1)
+                          for n, part in enumerate(parts))
+        assert bench_read(frames) == [text]
+
+        frame = client_frame(payload, mask)
+        print("Payload %7d bytes: bytewise %7.1f MB/s, unmask %8.1f MB/s, read frame %8.1f MB/s, fragmented %8.1f MB/s" % (
+              size, bench_rate(lambda: unmask_bytewise(masked, mask), size, args.seconds),
+              bench_rate(lambda: unmask(masked, mask), size, args.seconds),
+              bench_rate(lambda: bench_read(frame), size, args.seconds),
+              bench_rate(lambda: bench_read(frames), size, args.seconds)))